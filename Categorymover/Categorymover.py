@@ -1,4 +1,8 @@
 import asyncio
+import copy
+import heapq
+import re
+import time
 import typing
 from asyncio import Task
 
@@ -6,13 +10,18 @@ import discord
 from discord import Message
 from discord.abc import Snowflake
 from discord.ext import commands
+from pymongo import ReturnDocument
 
 from core import checks
 from core.models import getLogger, PermissionLevel
 from core.thread import Thread
 
-emojis = ["1️⃣", "2️⃣", "3️⃣", "4️⃣", "5️⃣", "6️⃣", "7️⃣", "8️⃣", "9️9️⃣"]
+emojis = ["1️⃣", "2️⃣", "3️⃣", "4️⃣", "5️⃣", "6️⃣", "7️⃣", "8️⃣", "9️⃣"]
 menu_description = "Please pick a category for your inquery"
+menu_modes = ["reactions", "select"]
+select_custom_id = "categorymover:select"
+category_channel_limit = 50  # Discord's limit of channels in a single category
+menu_timeout = 60 * 60  # seconds before an unanswered menu is removed
 
 
 class ReactionMenu(object):
@@ -23,7 +32,9 @@ class ReactionMenu(object):
         self.initial_message: Message
         self.options: dict[str, Snowflake]
         self.menu: Message
-        self.reaction_addr: Task
+        self.mode: str
+        self.created_at: float  # unix time, used to expire menus that were rehydrated after a restart
+        self.reaction_addr: typing.Optional[Task] = None
         self.is_dead: bool = False
 
     @classmethod
@@ -33,37 +44,94 @@ class ReactionMenu(object):
         self.thread = thread
         self.initial_message = initial_message
         self.options = {}
+        self.mode = self.cog.menu_mode
+        self.created_at = time.time()
 
         for (category, emoji) in zip(self.cog.categories.keys(), emojis):
             self.options[emoji] = category
 
-        self.menu = await self.thread.recipient.send(embed=self._gen_embed())
-        self.reaction_addr = asyncio.create_task(self._add_reactions())
+        if self.mode == "select":
+            # Single message with a select menu, interactions are handled by the cog's on_interaction listener
+            view = self._gen_view()
+            self.menu = await self.thread.recipient.send(embed=self._gen_embed(), view=view)
+            view.stop()
+        else:
+            self.menu = await self.thread.recipient.send(embed=self._gen_embed())
+            self.reaction_addr = asyncio.create_task(self._add_reactions())
+        await self.cog.save_menu(self)
+        return self
+
+    @classmethod
+    def rehydrate(cls, cog, thread, data):
+        """Rebuilds a menu saved by `Categorymoverplugin.save_menu` without fetching any messages"""
+        self = ReactionMenu()
+        self.cog = cog
+        self.thread = thread
+        self.initial_message = discord.Object(id=data["initial_message_id"])
+        self.options = dict((emoji, int(category)) for (emoji, category) in data["options"].items())
+        self.mode = data["mode"]
+        self.created_at = data["created_at"]
+        self.menu = cog.bot.get_partial_messageable(data["channel_id"]).get_partial_message(data["menu_id"])
         return self
 
-    async def disband(self, moved_to=None):
+    def serialize(self):
+        return {
+            "thread_id": self.thread.id,
+            "recipient_id": self.thread.recipient.id,
+            "channel_id": self.menu.channel.id,
+            "menu_id": self.menu.id,
+            "initial_message_id": self.initial_message.id,
+            "options": dict((emoji, str(category)) for (emoji, category) in self.options.items()),
+            "mode": self.mode,
+            "created_at": self.created_at,
+        }
+
+    async def disband(self, moved_to=None, option=None):
         if self.is_dead:
             return
         self.is_dead = True
-        self.reaction_addr.cancel()
-        await self.reaction_addr
-        if moved_to:
-            asyncio.create_task(self._clear_reactions(wait=3))
-            await self.menu.edit(embed=discord.Embed(color=self.cog.bot.main_color, description=f"✅ Moved to `{self.cog.categories.get(moved_to.id, 'Unknown')}`"))
-            await self.thread.channel.send(content=await self._get_pings(moved_to.id), embed=discord.Embed(description=f"Moved to <#{moved_to.id}>", color=self.cog.bot.main_color))
-        else:
-            await self.menu.delete()
-        del self.cog.running_responses[self.thread.id]
+        if self.reaction_addr:
+            self.reaction_addr.cancel()
+            await self.reaction_addr
+        try:
+            if moved_to:
+                option = option or moved_to.id
+                embed = discord.Embed(color=self.cog.bot.main_color, description=f"✅ Moved to `{self.cog.categories.get(option, 'Unknown')}`")
+                if self.mode == "select":
+                    await self.menu.edit(embed=embed, view=None)
+                else:
+                    asyncio.create_task(self._clear_reactions(wait=3))
+                    await self.menu.edit(embed=embed)
+                await self.cog.announce_move(self.thread, moved_to, option)
+            else:
+                await self.menu.delete()
+        finally:
+            self.cog.running_responses.remove(self)
+            await self.cog.forget_menu(self.menu.id)
 
     async def process(self, payload: discord.RawReactionActionEvent):
-        if self.is_dead:
-            return
         if payload.emoji.name not in self.options:
             return
-        category = discord.utils.get(self.cog.bot.modmail_guild.categories, id=self.options[payload.emoji.name])
+        await self.move(self.options[payload.emoji.name])
+
+    async def process_interaction(self, interaction: discord.Interaction):
+        await interaction.response.defer()
+        values = interaction.data.get("values", [])
+        if not values or int(values[0]) not in self.options.values():
+            return
+        await self.move(int(values[0]))
+
+    async def move(self, category_id):
+        if self.is_dead:
+            return
+        category = await self.cog.pick_category(category_id, self.thread.channel)
         if category:
-            await self.thread.channel.move(category=category, end=True, sync_permissions=True, reason="Thread was moved by Reaction menu within modmail")
-        await self.disband(moved_to=category)
+            try:
+                await self.thread.channel.move(category=category, end=True, sync_permissions=True, reason="Thread was moved by Reaction menu within modmail")
+            except discord.HTTPException:
+                self.cog.release_slot(self.thread.channel)
+                raise
+        await self.disband(moved_to=category, option=category_id)
 
     async def _add_reactions(self):
         try:
@@ -81,16 +149,17 @@ class ReactionMenu(object):
                 if reaction.me:
                     await reaction.remove(self.cog.bot.user)
 
-    async def _get_pings(self, category_id):  # noqa
-        ping_ids = self.cog.categories_ping.get(category_id, [])
-        if ping_ids:
-            pings = []
-            for _id in ping_ids:
-                obj: typing.Union[discord.member.Member, discord.role.Role] = discord.utils.get(self.cog.bot.modmail_guild.roles + self.cog.bot.modmail_guild.members, id=_id)
-                if obj is not None:
-                    pings.append(obj.mention)
-            return " ".join(pings)
-        return None
+    def _gen_view(self):
+        view = discord.ui.View(timeout=None)
+        view.add_item(discord.ui.Select(
+            custom_id=select_custom_id,
+            placeholder="Pick a category",
+            options=[
+                discord.SelectOption(label=self.cog.categories.get(category, 'Unknown')[:100], value=str(category), emoji=emoji)
+                for emoji, category in self.options.items()
+            ],
+        ))
+        return view
 
     def _gen_embed(self):
         embed = discord.Embed(color=self.cog.bot.main_color)
@@ -101,6 +170,223 @@ class ReactionMenu(object):
         return embed
 
 
+# a category's rules are combined into one pattern, so they can't use global flags or refer to groups by number or name
+rule_global_flags = re.compile(r"\(\?[aiLmsux]+\)")
+rule_group_references = re.compile(r"(?:^|[^\\])(?:\\\\)*(?:\\[1-9]|\(\?\()")
+
+
+class KeywordClassifier(object):
+    """Scores text against every category's rules
+
+    Each category gets its own combined regex, with one alternation across all categories the first
+    category's rule would consume text that overlaps a later one ("ban" hiding "ban appeal")
+    """
+
+    @staticmethod
+    def validate(rule: str):
+        """Raises ValueError when the rule can't be part of the combined pattern"""
+        try:
+            compiled = re.compile(rule)
+        except re.error as e:
+            raise ValueError(f"Invalid regex: {e}")
+        if rule_global_flags.search(rule):
+            raise ValueError("Inline flags like `(?i)` aren't supported, use a scoped group like `(?i:...)`")
+        if compiled.groupindex:
+            raise ValueError("Named groups aren't supported")
+        if rule_group_references.search(rule):
+            raise ValueError("Backreferences and conditional groups aren't supported")
+
+    def __init__(self, rules: dict[Snowflake, list[str]]):
+        self.patterns: dict[Snowflake, re.Pattern] = dict(
+            (category, re.compile("|".join(f"(?:{rule})" for rule in patterns), re.IGNORECASE))
+            for (category, patterns) in rules.items()
+            if patterns
+        )
+
+    def scores(self, text) -> dict[Snowflake, int]:
+        scores = {}
+        if not text:
+            return scores
+        for category, pattern in self.patterns.items():
+            count = sum(1 for _ in pattern.finditer(text))
+            if count:
+                scores[category] = count
+        return scores
+
+    def classify(self, text) -> typing.Optional[Snowflake]:
+        """Returns the category with the most matches, None when nothing matched or there is a tie"""
+        ranked = sorted(self.scores(text).items(), key=lambda item: item[1], reverse=True)
+        if not ranked or (len(ranked) > 1 and ranked[0][1] == ranked[1][1]):
+            return None
+        return ranked[0][0]
+
+
+class MenuRegistry(object):
+    """Running menus indexed by thread and menu message, with a heap of expiry deadlines"""
+
+    def __init__(self):
+        self.by_thread: dict[Snowflake, ReactionMenu] = {}
+        self.by_message: dict[Snowflake, ReactionMenu] = {}
+        self.deadlines: list[tuple[float, Snowflake, ReactionMenu]] = []  # deadline, thread id, menu
+        self.expired = 0
+
+    def __len__(self):
+        return len(self.by_thread)
+
+    def __contains__(self, thread_id):
+        return thread_id in self.by_thread
+
+    def get(self, thread_id) -> typing.Optional[ReactionMenu]:
+        return self.by_thread.get(thread_id)
+
+    def add(self, menu: ReactionMenu, timeout=None):
+        self.by_thread[menu.thread.id] = menu
+        self.by_message[menu.menu.id] = menu
+        if timeout:
+            heapq.heappush(self.deadlines, (time.monotonic() + timeout, menu.thread.id, menu))
+
+    def remove(self, menu: ReactionMenu):
+        # deadlines are left in the heap and skipped once they come up
+        if self.by_thread.get(menu.thread.id) is menu:
+            del self.by_thread[menu.thread.id]
+        if self.by_message.get(menu.menu.id) is menu:
+            del self.by_message[menu.menu.id]
+
+    def next_deadline(self) -> typing.Optional[float]:
+        while self.deadlines and self.by_thread.get(self.deadlines[0][1]) is not self.deadlines[0][2]:
+            heapq.heappop(self.deadlines)
+        return self.deadlines[0][0] if self.deadlines else None
+
+    def pop_expired(self, now) -> list[ReactionMenu]:
+        expired = []
+        while (deadline := self.next_deadline()) is not None and deadline <= now:
+            menu = heapq.heappop(self.deadlines)[2]
+            self.remove(menu)
+            expired.append(menu)
+        self.expired += len(expired)
+        return expired
+
+
+config_write_delay = 2  # seconds config changes are held for before being written as one update
+config_poll_interval = 30  # seconds between checks for config changes made by other bot instances
+
+
+class ConfigStore(object):
+    """
+    Versioned snapshot of the plugin config document
+
+    Writes are coalesced into a single `$set` of the changed fields, every write bumps `version`
+    so other bot instances sharing the database notice the change from a cheap poll and reload.
+    """
+
+    def __init__(self, db, on_load, logger, delay=config_write_delay, poll_interval=config_poll_interval):
+        self.db = db
+        self.on_load = on_load  # called with the config document (or None) whenever a new snapshot is loaded
+        self.logger = logger
+        self.delay = delay
+        self.poll_interval = poll_interval
+        self.values: dict = {}
+        self.saved: dict = {}  # values as they are in the db
+        self.version = 0
+        self.loaded = False  # nothing is written before the stored config has been read once
+        self.dirty: set[str] = set()
+        self.lock = asyncio.Lock()
+        self.ready = asyncio.Event()
+        self.flush_task: typing.Optional[asyncio.Task] = None
+        self.watcher: typing.Optional[asyncio.Task] = None
+
+    def start(self):
+        self.watcher = asyncio.create_task(self._watch())
+
+    async def load(self):
+        async with self.lock:
+            if self.loaded and self.dirty:
+                return  # staged changes would be dropped, the next poll after they are written reloads
+            config = await self.db.find_one({"_id": "config"})
+            if config is not None:
+                config.pop("_id")
+                self.version = config.pop("version", 0)
+                self.values = config
+                self.saved = copy.deepcopy(config)
+            self.loaded = True
+        await self.on_load(config)
+
+    async def _watch(self):
+        # retried until it succeeds, events and commands wait on `ready` rather than running on the defaults
+        attempt = 0
+        while not self.loaded:
+            try:
+                await self.load()
+            except Exception:
+                self.logger.warning("Failed to load the config, retrying", exc_info=True)
+                await asyncio.sleep(min(2 ** attempt, self.poll_interval))
+                attempt += 1
+        self.ready.set()
+
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            if self.dirty:
+                continue  # reloaded once our own changes are written
+            try:
+                data = await self.db.find_one({"_id": "config"}, {"version": 1})
+                if data is not None and data.get("version", 0) != self.version:
+                    self.logger.debug("Config changed by another instance, reloading")
+                    await self.load()
+            except Exception:
+                self.logger.warning("Failed to poll the config", exc_info=True)
+
+    def update(self, values: dict):
+        """Stages `values` and schedules a write, lists/dicts mutated in place are picked up when flushing"""
+        self.values.update(values)
+        self.dirty.update(values.keys())
+        if self.flush_task is None or self.flush_task.done():
+            self.flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        # keeps going while changes come in during a write, those would otherwise wait for the next update
+        while self.dirty:
+            await asyncio.sleep(self.delay)
+            await self.flush()
+
+    async def flush(self):
+        if not self.loaded:
+            return  # the defaults would overwrite the stored config, kept in `dirty` until it is loaded
+        async with self.lock:
+            dirty, self.dirty = self.dirty, set()
+            changed = {key: self.values[key] for key in dirty if key in self.values and self.saved.get(key, ...) != self.values[key]}
+            if not changed:
+                return
+
+            try:
+                data = await self.db.find_one_and_update(
+                    {"_id": "config"},
+                    {"$set": changed, "$inc": {"version": 1}},
+                    {"version": 1},
+                    upsert=True,
+                    return_document=ReturnDocument.AFTER,
+                )
+            except BaseException:
+                # also on cancellation, the keys were already taken out of `dirty`
+                self.dirty |= dirty
+                raise
+            self.saved.update(copy.deepcopy(changed))
+            # a skipped version means another instance wrote in between, the watcher picks up its changes
+            if data["version"] == self.version + 1:
+                self.version = data["version"]
+
+    async def close(self):
+        if self.watcher is not None:
+            self.watcher.cancel()
+        if self.flush_task is not None and not self.flush_task.done():
+            # a write in progress puts its keys back into `dirty` when cancelled, the flush below writes them
+            self.flush_task.cancel()
+            try:
+                await self.flush_task
+            except asyncio.CancelledError:
+                pass
+        await self.flush()
+
+
 class Categorymoverplugin(commands.Cog):
     """Move threads automatically to reduce the worry for thread limit as well as better organization"""
 
@@ -108,45 +394,275 @@ class Categorymoverplugin(commands.Cog):
         self.bot = bot
         self.db = bot.plugin_db.get_partition(self)
         self.logger = getLogger("CategoryMover")
-        self.running_responses: dict[Snowflake, ReactionMenu] = {}  # userid, reactionMenu
+        self.config = ConfigStore(self.db, self._set_options, self.logger)
+        self.running_responses = MenuRegistry()
+        self.reaper_wakeup = asyncio.Event()
+        self.saved_menus: set[Snowflake] = set()  # menu message ids saved in the db that aren't running
 
         # settings
         self.enabled = True
         self.categories: dict[Snowflake, str] = {}  # Category, Category Description
-        self.categories_ping: dict[Snowflake, list[Snowflake]]
+        self.categories_ping: dict[Snowflake, list[Snowflake]] = {}
         self.menu_description = menu_description
+        self.menu_mode = menu_modes[0]
+        self.categories_overflow: dict[Snowflake, list[Snowflake]] = {}  # Category, overflow categories used when it is full
+        self.auto_overflow = False
+        self.menu_timeout = menu_timeout
+        self.category_rules: dict[Snowflake, list[str]] = {}  # Category, keyword/regex rules
+        self.auto_route = False
+        self.classifier = KeywordClassifier({})
+
+        # category id -> amount of channels, built on first use and kept up to date from channel events
+        self.channel_counts: typing.Optional[dict[Snowflake, int]] = None
+        # thread channel id -> category counted for a move the gateway hasn't confirmed yet
+        self.reserved_slots: dict[Snowflake, Snowflake] = {}
+
+        # category id -> mention string, rebuilt lazily after config changes or a pinged role/member going away
+        self.ping_cache: dict[Snowflake, typing.Optional[str]] = {}
+        self.ping_ids: set[Snowflake] = set()
+
+        self.config.start()
+        asyncio.create_task(self._load_saved_menus())
+        self.reaper = asyncio.create_task(self._reap_menus())
+
+    async def cog_before_invoke(self, ctx):
+        await self.config.ready.wait()
+
+    async def cog_unload(self):
+        self.reaper.cancel()
+        await self.config.close()
+
+    async def save_menu(self, menu: ReactionMenu):
+        await self.db.update_one({"_id": f"menu-{menu.menu.id}"}, {"$set": menu.serialize()}, upsert=True)
+
+    async def forget_menu(self, menu_id):
+        self.saved_menus.discard(menu_id)
+        await self.db.delete_one({"_id": f"menu-{menu_id}"})
+
+    async def _load_saved_menus(self):
+        """Only the ids are loaded, menus are rehydrated once someone uses them"""
+        async for data in self.db.find({"menu_id": {"$exists": True}}, {"menu_id": 1}):
+            if data["menu_id"] not in self.running_responses.by_message:
+                self.saved_menus.add(data["menu_id"])
+
+    async def _get_menu(self, message_id, user_id) -> typing.Optional[ReactionMenu]:
+        menu = self.running_responses.by_message.get(message_id)
+        if menu is None and message_id in self.saved_menus:
+            menu = await self._rehydrate_menu(message_id)
+        if menu is not None and menu.thread.recipient.id == user_id:
+            return menu
+        return None
+
+    async def _rehydrate_menu(self, message_id) -> typing.Optional[ReactionMenu]:
+        self.saved_menus.discard(message_id)
+        data = await self.db.find_one({"_id": f"menu-{message_id}"})
+        if data is None:
+            return None
+
+        thread = await self.bot.threads.find(recipient_id=data["recipient_id"])
+        remaining = data["created_at"] + self.menu_timeout - time.time() if self.menu_timeout else None
+        if thread is None or thread.id != data["thread_id"] or (remaining is not None and remaining <= 0):
+            await self.forget_menu(message_id)
+            return None
+
+        menu = ReactionMenu.rehydrate(self, thread, data)
+        self.running_responses.add(menu, timeout=remaining)
+        self.reaper_wakeup.set()
+        return menu
+
+    async def _reap_menus(self):
+        """Disbands menus nobody answered within the menu timeout"""
+        while True:
+            deadline = self.running_responses.next_deadline()
+            self.reaper_wakeup.clear()
+            try:
+                await asyncio.wait_for(self.reaper_wakeup.wait(), timeout=None if deadline is None else max(deadline - time.monotonic(), 0))
+            except asyncio.TimeoutError:
+                pass
+            for menu in self.running_responses.pop_expired(time.monotonic()):
+                try:
+                    await menu.disband()
+                except Exception:
+                    # anything escaping here would end the reaper and menus would stop expiring
+                    self.logger.warning(f"Failed to remove expired menu for thread {menu.thread.id}", exc_info=True)
+
+    async def announce_move(self, thread, category, option):
+        await thread.channel.send(content=self.get_pings(option), embed=discord.Embed(description=f"Moved to <#{category.id}>", color=self.bot.main_color))
+
+    async def _auto_route(self, thread, initial_message) -> bool:
+        """Moves the thread straight away if the first message clearly matches one category's rules"""
+        option = self.classifier.classify(getattr(initial_message, "content", None))
+        if option is None or option not in self.categories:
+            return False
+        category = await self.pick_category(option, thread.channel)
+        if category is None:
+            return False
+        try:
+            await thread.channel.move(category=category, end=True, sync_permissions=True, reason="Thread was moved by keyword rules within modmail")
+        except discord.HTTPException:
+            # the menu is sent instead, so the thread still ends up somewhere
+            self.release_slot(thread.channel)
+            self.logger.warning(f"Failed to move thread {thread.id} by keyword rules, sending the menu", exc_info=True)
+            return False
+        await self.announce_move(thread, category, option)
+        return True
+
+    def _get_mentionable(self, _id) -> typing.Optional[typing.Union[discord.member.Member, discord.role.Role]]:
+        guild = self.bot.modmail_guild
+        return guild.get_role(_id) or guild.get_member(_id)
+
+    def get_pings(self, category_id):
+        if category_id in self.ping_cache:
+            return self.ping_cache[category_id]
+        pings = []
+        resolved = True
+        for _id in self.categories_ping.get(category_id, []):
+            obj = self._get_mentionable(_id)
+            if obj is not None:
+                pings.append(obj.mention)
+            else:
+                resolved = False
+        mentions = " ".join(pings) or None
+        # misses aren't cached, the member may only be missing because the guild hasn't chunked yet
+        if resolved:
+            self.ping_cache[category_id] = mentions
+        return mentions
+
+    def _invalidate_pings(self, _id=None):
+        if _id is None:
+            self.ping_ids = {_id for ids in self.categories_ping.values() for _id in ids}
+            self.ping_cache.clear()
+        elif _id in self.ping_ids:
+            self.ping_cache.clear()
+
+    def _get_channel_counts(self):
+        if self.channel_counts is None:
+            self.channel_counts = {c.id: len(c.channels) for c in self.bot.modmail_guild.categories}
+        return self.channel_counts
+
+    async def pick_category(self, category_id, channel=None):
+        """Gets the first category of the option's pool with room for another channel, creating one if enabled
+
+        With a channel the slot is reserved straight away, so concurrent moves don't all pick the same free slot
+        """
+        counts = self._get_channel_counts()
+        pool = [category_id, *self.categories_overflow.get(category_id, [])]
+        category = next((self.bot.modmail_guild.get_channel(_id) for _id in pool
+                         if _id in counts and counts[_id] < category_channel_limit), None)
+
+        if category is None:
+            primary = self.bot.modmail_guild.get_channel(category_id)
+            if not self.auto_overflow or primary is None:
+                self.logger.warning(f"All categories for {category_id} are full, not moving thread")
+                return None
+            category = await primary.clone(name=f"{primary.name} {len(pool) + 1}", reason="Categorymover overflow category")
+            counts.setdefault(category.id, 0)
+            self.categories_overflow.setdefault(category_id, []).append(category.id)
+            await self._update_config()
+
+        if channel is not None and category is not None:
+            self.release_slot(channel)
+            # a channel already in the category is counted there, and its update won't change category_id
+            if channel.category_id != category.id:
+                counts[category.id] = counts.get(category.id, 0) + 1
+                self.reserved_slots[channel.id] = category.id
+        return category
+
+    def release_slot(self, channel):
+        """Gives back a slot reserved by `pick_category` for a move that didn't happen"""
+        category_id = self.reserved_slots.pop(channel.id, None)
+        if category_id is not None and self.channel_counts is not None and category_id in self.channel_counts:
+            self.channel_counts[category_id] -= 1
 
-        asyncio.create_task(self._set_options())
+    def _is_tracked(self, channel):
+        return self.channel_counts is not None and channel.guild.id == self.bot.modmail_guild.id
 
     @commands.Cog.listener()
-    async def on_raw_reaction_add(self, payload: discord.RawReactionActionEvent):
-        if len(self.running_responses.keys()) == 0:
+    async def on_guild_channel_create(self, channel):
+        if not self._is_tracked(channel):
+            return
+        if isinstance(channel, discord.CategoryChannel):
+            self.channel_counts.setdefault(channel.id, 0)
+        elif channel.category_id in self.channel_counts:
+            self.channel_counts[channel.category_id] += 1
+
+    @commands.Cog.listener()
+    async def on_guild_channel_delete(self, channel):
+        if not self._is_tracked(channel):
+            return
+        if isinstance(channel, discord.CategoryChannel):
+            self.channel_counts.pop(channel.id, None)
             return
+        self.release_slot(channel)
+        if channel.category_id in self.channel_counts:
+            self.channel_counts[channel.category_id] -= 1
+
+    @commands.Cog.listener()
+    async def on_guild_channel_update(self, before, after):
+        if not self._is_tracked(after) or before.category_id == after.category_id:
+            return
+        if before.category_id in self.channel_counts:
+            self.channel_counts[before.category_id] -= 1
+        if self.reserved_slots.get(after.id) == after.category_id:
+            del self.reserved_slots[after.id]  # counted when the slot was picked
+            return
+        self.release_slot(after)
+        if after.category_id in self.channel_counts:
+            self.channel_counts[after.category_id] += 1
+
+    @commands.Cog.listener()
+    async def on_guild_role_delete(self, role):
+        self._invalidate_pings(role.id)
+
+    @commands.Cog.listener()
+    async def on_member_join(self, member):
+        self._invalidate_pings(member.id)
 
-        if payload.guild_id or payload.user_id not in self.running_responses or payload.user_id == self.bot.user.id:
+    @commands.Cog.listener()
+    async def on_member_remove(self, member):
+        self._invalidate_pings(member.id)
+
+    @commands.Cog.listener()
+    async def on_raw_reaction_add(self, payload: discord.RawReactionActionEvent):
+        if payload.guild_id:
             return
 
-        if self.running_responses[payload.user_id].menu.id == payload.message_id:
-            return await self.running_responses[payload.user_id].process(payload)
+        menu = await self._get_menu(payload.message_id, payload.user_id)
+        if menu is not None:
+            return await menu.process(payload)
+
+    @commands.Cog.listener()
+    async def on_interaction(self, interaction: discord.Interaction):
+        if interaction.type != discord.InteractionType.component or interaction.data.get("custom_id") != select_custom_id:
+            return
+        menu = await self._get_menu(interaction.message.id, interaction.user.id)
+        if menu is not None:
+            return await menu.process_interaction(interaction)
+        # always answered, otherwise discord shows the user "This interaction failed"
+        await interaction.response.send_message("This menu is no longer active.", ephemeral=True)
 
     @commands.Cog.listener()
     async def on_thread_close(self, thread, closer, silent, delete_channel, message, scheduled):
         if thread.id not in self.running_responses:
+            if self.saved_menus:
+                await self.db.delete_many({"thread_id": thread.id, "menu_id": {"$exists": True}})
             return
-        await self.running_responses[thread.id].disband()
+        await self.running_responses.get(thread.id).disband()
 
     @commands.Cog.listener()
     async def on_thread_reply(self, thread, from_mod, message, anonymous, plain):
-        threadMenu = self.running_responses.get(thread.id, None)
+        threadMenu = self.running_responses.get(thread.id)
         if not threadMenu:
             return
 
         if message.id in (threadMenu.menu.id, threadMenu.initial_message.id, threadMenu.thread.genesis_message.id):
             return
-        await self.running_responses[thread.id].disband()
+        await threadMenu.disband()
 
     @commands.Cog.listener()
     async def on_thread_ready(self, thread, creator, category, initial_message):
+        if not self.config.ready.is_set():
+            await self.config.ready.wait()
         if not self.enabled or not len(self.categories.keys()) >= 2:
             return
 
@@ -156,7 +672,11 @@ class Categorymoverplugin(commands.Cog):
                 f"Ignoring thread for user {str(thread.recipient)} ({thread.recipient.id}) Created by contact like function or thread has more then one recipients")
             return
 
-        self.running_responses[thread.id] = await ReactionMenu.create(self, thread, initial_message)
+        if self.auto_route and await self._auto_route(thread, initial_message):
+            return
+
+        self.running_responses.add(await ReactionMenu.create(self, thread, initial_message), timeout=self.menu_timeout)
+        self.reaper_wakeup.set()
 
     @commands.group(name="cm", invoke_without_command=True)
     @checks.has_permissions(PermissionLevel.ADMIN)
@@ -191,6 +711,9 @@ class Categorymoverplugin(commands.Cog):
 
         if target.id in self.categories:
             del self.categories[target.id]
+            self.categories_overflow.pop(target.id, None)
+            if self.category_rules.pop(target.id, None):
+                self.classifier = KeywordClassifier(self.category_rules)
         else:
             if len(self.categories.keys()) > 9:
                 return await ctx.send(
@@ -214,17 +737,18 @@ class Categorymoverplugin(commands.Cog):
         if mentionable is None:
             desc = []
             for _id in self.categories_ping.get(target.id, []):
-                obj: typing.Union[discord.member.Member, discord.role.Role] = discord.utils.get(self.bot.modmail_guild.roles + self.bot.modmail_guild.members, id=_id)
+                obj = self._get_mentionable(_id)
                 if obj is not None:
                     desc.append(f"{str(obj)} - (`{obj.id}`)")
             return await ctx.send(embed=discord.Embed(color=self.bot.main_color, description="\n".join(desc)))
 
         if mentionable.id in self.categories_ping.get(target.id, []):
-            self.categories_ping.get(target.id, []).remove(mentionable.id)
+            self.categories_ping[target.id].remove(mentionable.id)
             await ctx.send(embed=discord.Embed(color=self.bot.main_color, description=f"Removed {mentionable} ({mentionable.id}) to {target} ({target.id})"))
         else:
-            self.categories_ping.get(target.id, []).append(mentionable.id)
+            self.categories_ping.setdefault(target.id, []).append(mentionable.id)
             await ctx.send(embed=discord.Embed(color=self.bot.main_color, description=f"Added {mentionable} ({mentionable.id}) to {target} ({target.id})"))
+        self._invalidate_pings()
         await self._update_config()
 
     @cm.command("set_description")
@@ -243,6 +767,159 @@ class Categorymoverplugin(commands.Cog):
         return await ctx.send(embed=discord.Embed(color=self.bot.main_color,
                                                   description=f"Menu Description set to:\n`{self.menu_description}`"))
 
+    @cm.command("overflow")
+    @checks.has_permissions(PermissionLevel.ADMIN)
+    async def cm_overflow(self, ctx, target: discord.CategoryChannel, overflow: discord.CategoryChannel = None):
+        """Add or remove overflow categories used when a menu category is full
+
+        Without an overflow category it lists the current ones
+        Usage: `cm overflow (category_id) (overflow_category_id)`
+        """
+        if target.id not in self.categories:
+            raise commands.BadArgument(f"{target} is not a menu category")
+
+        if overflow is None:
+            counts = self._get_channel_counts()
+            desc = [f"{self.bot.modmail_guild.get_channel(_id)} (`{_id}`) - {counts.get(_id, 0)}/{category_channel_limit}"
+                    for _id in [target.id, *self.categories_overflow.get(target.id, [])]]
+            return await ctx.send(embed=discord.Embed(color=self.bot.main_color, description="\n".join(desc)))
+
+        if overflow.id in self.categories_overflow.get(target.id, []):
+            self.categories_overflow[target.id].remove(overflow.id)
+        elif overflow.id != target.id:
+            self.categories_overflow.setdefault(target.id, []).append(overflow.id)
+        await self._update_config()
+        return await ctx.send(embed=discord.Embed(color=self.bot.main_color,
+                                                  description=f"{overflow} ({overflow.id}) has been {'added to' if overflow.id in self.categories_overflow.get(target.id, []) else 'removed from'} {target} ({target.id})"))
+
+    @cm.command("autooverflow")
+    @checks.has_permissions(PermissionLevel.ADMIN)
+    async def cm_autooverflow(self, ctx):
+        """Enable or disable creating overflow categories when every category of a menu option is full
+
+        Usage: `cm autooverflow`
+        """
+        self.auto_overflow = not self.auto_overflow
+        await self._update_config()
+        return await ctx.send(embed=discord.Embed(color=self.bot.main_color,
+                                                  description="Automatic overflow categories have been " + ("enabled" if self.auto_overflow else "disabled")))
+
+    @cm.command("rule")
+    @checks.has_permissions(PermissionLevel.ADMIN)
+    async def cm_rule(self, ctx, target: discord.CategoryChannel, *, pattern: str = None):
+        """Add or remove a keyword/regex rule used to route threads without the menu
+
+        Without a pattern it lists the category's rules
+        Usage: `cm rule (category_id) (regex)`
+        """
+        if target.id not in self.categories:
+            raise commands.BadArgument(f"{target} is not a menu category")
+
+        if pattern is None:
+            rules = self.category_rules.get(target.id, [])
+            return await ctx.send(embed=discord.Embed(color=self.bot.main_color, description="\n".join(f"`{rule}`" for rule in rules) or "No rules"))
+
+        # the combined pattern is built before anything is stored, a rule that breaks it must never be saved
+        rules = dict((key, list(value)) for (key, value) in self.category_rules.items())
+        added = pattern not in rules.get(target.id, [])
+        try:
+            if added:
+                KeywordClassifier.validate(pattern)
+                rules.setdefault(target.id, []).append(pattern)
+            else:
+                rules[target.id].remove(pattern)
+            classifier = KeywordClassifier(rules)
+        except (ValueError, re.error) as e:
+            raise commands.BadArgument(str(e))
+        self.category_rules = rules
+        self.classifier = classifier
+        await self._update_config()
+        return await ctx.send(embed=discord.Embed(color=self.bot.main_color,
+                                                  description=f"`{pattern}` has been {'added to' if added else 'removed from'} {target} ({target.id})"))
+
+    @cm.command("autoroute")
+    @checks.has_permissions(PermissionLevel.ADMIN)
+    async def cm_autoroute(self, ctx):
+        """Enable or disable moving threads that clearly match a category's rules without sending the menu
+
+        Usage: `cm autoroute`
+        """
+        self.auto_route = not self.auto_route
+        await self._update_config()
+        return await ctx.send(embed=discord.Embed(color=self.bot.main_color,
+                                                  description="Keyword routing has been " + ("enabled" if self.auto_route else "disabled")))
+
+    @cm.command("evaluate")
+    @checks.has_permissions(PermissionLevel.ADMIN)
+    async def cm_evaluate(self, ctx, limit: int = 500):
+        """Replays the first user message of recent closed logs through the rules to see how many would be routed
+
+        Usage: `cm evaluate (amount of logs)`
+        """
+        evaluated, ties = 0, 0
+        routed: dict[Snowflake, int] = {}
+        cursor = self.bot.db.logs.find(
+            {"open": False, "guild_id": str(self.bot.guild_id)},
+            {"messages": {"$slice": 5}},
+        ).sort("created_at", -1).limit(limit)
+        async for log in cursor:
+            content = next((m.get("content") for m in log.get("messages", [])
+                            if m.get("type", "thread_message") == "thread_message" and m.get("author") and not m["author"].get("mod")), None)
+            if not content:
+                continue
+            evaluated += 1
+            scores = self.classifier.scores(content)
+            option = self.classifier.classify(content)
+            if option is not None:
+                routed[option] = routed.get(option, 0) + 1
+            elif scores:
+                ties += 1
+
+        hits = sum(routed.values())
+        rows = [f"Evaluated {evaluated} logs, {hits} would be routed ({hits / evaluated:.0%}), {ties} ties" if evaluated else "No logs to evaluate"]
+        for category, count in sorted(routed.items(), key=lambda item: item[1], reverse=True):
+            rows.append(f"{self.categories.get(category, 'Unknown')} - {count}")
+        return await ctx.send(embed=discord.Embed(color=self.bot.main_color, description="\n".join(rows)))
+
+    @cm.command("timeout")
+    @checks.has_permissions(PermissionLevel.ADMIN)
+    async def cm_timeout(self, ctx, seconds: int = None):
+        """Sets how long a menu waits for an answer before it is removed
+
+        0 keeps menus until the thread is answered or closed
+        Usage: `cm timeout (seconds)`
+        """
+        if seconds is None or seconds < 0:
+            return await ctx.send(embed=discord.Embed(color=self.bot.main_color, description=f"Menu timeout is `{self.menu_timeout}` seconds"))
+        self.menu_timeout = seconds
+        await self._update_config()
+        return await ctx.send(embed=discord.Embed(color=self.bot.main_color, description=f"Menu timeout set to `{self.menu_timeout}` seconds"))
+
+    @cm.command("stats")
+    @checks.has_permissions(PermissionLevel.MOD)
+    async def cm_stats(self, ctx):
+        """Shows how many menus are running and how many have expired since the plugin loaded
+
+        Usage: `cm stats`
+        """
+        return await ctx.send(embed=discord.Embed(color=self.bot.main_color,
+                                                  description=f"Active menus: {len(self.running_responses)}\nExpired menus: {self.running_responses.expired}"))
+
+    @cm.command("mode")
+    @checks.has_permissions(PermissionLevel.ADMIN)
+    async def cm_mode(self, ctx, mode: str.lower = None):
+        """Sets how users pick a category
+
+        `reactions` adds a reaction per category, `select` sends a single message with a select menu
+        Usage: `cm mode (reactions/select)`
+        """
+        if mode not in menu_modes:
+            return await ctx.send(embed=discord.Embed(color=self.bot.main_color,
+                                                      description=f"Menu mode is `{self.menu_mode}`, available modes: {', '.join(f'`{m}`' for m in menu_modes)}"))
+        self.menu_mode = mode
+        await self._update_config()
+        return await ctx.send(embed=discord.Embed(color=self.bot.main_color, description=f"Menu mode set to `{self.menu_mode}`"))
+
     @cm.command("embed", aliases=["categories"])
     @checks.has_permissions(PermissionLevel.MOD)
     async def cm_categories(self, ctx):
@@ -259,22 +936,22 @@ class Categorymoverplugin(commands.Cog):
         return await ctx.send(content="Menu example:", embed=embed)
 
     async def _update_config(self):
-        await self.db.find_one_and_update(
-            {"_id": "config"},
+        self.config.update(
             {
-                "$set": {
-                    "enabled": self.enabled,
-                    "categories": dict((str(key), value) for (key, value) in self.categories.items()),
-                    "categories_ping": dict((str(key), value) for (key, value) in self.categories_ping.items()),
-                    "menu_description": self.menu_description
-                }
-            },
-            upsert=True,
+                "enabled": self.enabled,
+                "categories": dict((str(key), value) for (key, value) in self.categories.items()),
+                "categories_ping": dict((str(key), value) for (key, value) in self.categories_ping.items()),
+                "menu_description": self.menu_description,
+                "menu_mode": self.menu_mode,
+                "categories_overflow": dict((str(key), value) for (key, value) in self.categories_overflow.items()),
+                "auto_overflow": self.auto_overflow,
+                "menu_timeout": self.menu_timeout,
+                "category_rules": dict((str(key), value) for (key, value) in self.category_rules.items()),
+                "auto_route": self.auto_route,
+            }
         )
 
-    async def _set_options(self):
-        config = await self.db.find_one({"_id": "config"})
-
+    async def _set_options(self, config: typing.Optional[dict]):
         if config is None:
             await self._update_config()
             return
@@ -283,6 +960,19 @@ class Categorymoverplugin(commands.Cog):
         self.categories = dict((int(key), value) for (key, value) in config.get("categories", {}).items())
         self.categories_ping = dict((int(key), value) for (key, value) in config.get("categories_ping", {}).items())
         self.menu_description = config.get("menu_description", menu_description)
+        self.menu_mode = config.get("menu_mode", menu_modes[0])
+        self.categories_overflow = dict((int(key), value) for (key, value) in config.get("categories_overflow", {}).items())
+        self.auto_overflow = config.get("auto_overflow", False)
+        self.menu_timeout = config.get("menu_timeout", menu_timeout)
+        self.category_rules = dict((int(key), value) for (key, value) in config.get("category_rules", {}).items())
+        self.auto_route = config.get("auto_route", False)
+        try:
+            self.classifier = KeywordClassifier(self.category_rules)
+        except re.error:
+            # rules saved before they were validated against the combined pattern, routing stays off until fixed
+            self.logger.warning("Category rules don't compile together, keyword routing is disabled", exc_info=True)
+            self.classifier = KeywordClassifier({})
+        self._invalidate_pings()
 
 
 async def setup(bot):
@@ -1,24 +1,426 @@
 import asyncio
+import hashlib
+import json
+import multiprocessing
 import sqlite3
 import re
 import os
+import tempfile
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
-import secrets
-from io import BytesIO
 
+import bson
 import discord
 from discord.ext import commands
+from pymongo.errors import BulkWriteError
 
 # This used to be included in kyb3r/modmail-plugins but it has been broken so Wanted to fix it uwu
 
-USER_CACHE = {}
+# Uploads up to this size (in bytes) are deserialized straight into an in-memory database
+MEMORY_DB_THRESHOLD = 64 * 1024 * 1024
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Buffered log documents are flushed once either limit is reached (mongo caps a single batch at 48MB)
+LOG_BATCH_SIZE = 500
+LOG_BATCH_BYTES = 16 * 1024 * 1024
+DUPLICATE_KEY_ERROR = 11000
+
+PREFETCH_CONCURRENCY = 8
+PREFETCH_RETRIES = 5
+
+# Minimum seconds between edits of the progress message
+PROGRESS_INTERVAL = 5
+
+# Threads converted to measure throughput with --dry-run
+DRY_RUN_SAMPLE = 200
+
+# Threads handed to a worker process at once when converting with --processes
+PROCESS_CHUNK_SIZE = 200
+
+USER_CACHE_SIZE = 100_000
+# Where resolved users are persisted between migrations, None to disable
+# Kept next to the plugin rather than in the shared temp dir where other local users could plant entries
+USER_CACHE_SNAPSHOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "users.json")
+AVATAR_URL_PREFIX = "https://cdn.discordapp.com/"
+
+
+class CachedUser:
+    """The parts of a user that end up in a log document"""
+
+    __slots__ = ("id", "name", "discriminator", "avatar_url")
+
+    def __init__(self, id, name, discriminator, avatar_url):
+        self.id = id
+        self.name = name
+        self.discriminator = discriminator
+        self.avatar_url = avatar_url
+
+    @classmethod
+    def from_user(cls, user):
+        return cls(user.id, user.name, user.discriminator, str(user.display_avatar.url))
+
+    @property
+    def mention(self):
+        return f"<@{self.id}>"
+
+    def __str__(self):
+        return f"{self.name}#{self.discriminator}"
+
+
+class UserCache:
+    """Size bounded LRU of CachedUser's, None is stored for users that don't exist
+
+    Users of the running migration are pinned outside the LRU, conversion only reads the cache
+    so they can't be evicted before it gets to them. The bound only applies to what is kept between runs.
+    """
+
+    def __init__(self, max_size=USER_CACHE_SIZE):
+        self.max_size = max_size
+        self._users: OrderedDict[int, CachedUser | None] = OrderedDict()
+        self._pinned_ids: set[int] = set()
+        self._pinned: dict[int, CachedUser | None] = {}
+
+    def __contains__(self, user_id):
+        return user_id in self._pinned or user_id in self._users
+
+    def __len__(self):
+        return len(self._pinned) + len(self._users)
+
+    def get(self, user_id):
+        if user_id in self._pinned:
+            return self._pinned[user_id]
+        user = self._users.get(user_id)
+        if user is not None:
+            self._users.move_to_end(user_id)
+        return user
+
+    def __setitem__(self, user_id, user):
+        if user is not None and not isinstance(user, CachedUser):
+            user = CachedUser.from_user(user)
+        if user_id in self._pinned_ids:
+            self._pinned[user_id] = user
+            return
+        self._users[user_id] = user
+        self._users.move_to_end(user_id)
+        while len(self._users) > self.max_size:
+            self._users.popitem(last=False)
+
+    def pin(self, user_ids):
+        """Keeps `user_ids` out of the LRU until `unpin`"""
+        self._pinned_ids.update(user_ids)
+        for user_id in self._pinned_ids.intersection(self._users):
+            self._pinned[user_id] = self._users.pop(user_id)
+
+    def unpin(self):
+        pinned, self._pinned, self._pinned_ids = self._pinned, {}, set()
+        for user_id, user in pinned.items():
+            self[user_id] = user
+
+    def load(self, path):
+        """Loads a snapshot made by `save`, returns the amount of users loaded"""
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError):
+            return 0
+        if not isinstance(snapshot, dict):
+            return 0
+
+        loaded = 0
+        for user_id, user in snapshot.items():
+            # entries that don't look like what `save` writes are skipped, they'd end up in the migrated logs
+            if not user_id.isdigit():
+                continue
+            if user is None:
+                self[int(user_id)] = None
+            elif (
+                isinstance(user, list)
+                and len(user) == 3
+                and all(isinstance(value, str) for value in user)
+                and user[2].startswith(AVATAR_URL_PREFIX)
+            ):
+                self[int(user_id)] = CachedUser(int(user_id), *user)
+            else:
+                continue
+            loaded += 1
+        return loaded
+
+    def save(self, path):
+        snapshot = {
+            str(user_id): [user.name, user.discriminator, user.avatar_url] if user is not None else None
+            for user_id, user in (*self._users.items(), *self._pinned.items())
+        }
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(snapshot, f)
+
+
+USER_CACHE = UserCache()
+
+
+class DragoryDatabase:
+    """Read only handle to a downloaded Dragory sqlite database
+
+    All sqlite work runs on a single worker thread so the event loop is never blocked
+    """
+
+    def __init__(self, executor, conn, digest, path=None):
+        self.executor = executor
+        self.conn = conn
+        self.digest = digest  # sha256 of the source file
+        self.path = path
+
+    @classmethod
+    async def download(cls, session, url):
+        """Streams the database at `url` into memory or a unique temp file and opens it"""
+        executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="dragorydb")
+        loop = asyncio.get_running_loop()
+        path = None
+        try:
+            async with session.get(url) as resp:
+                resp.raise_for_status()
+                size = resp.content_length
+                if size is not None and size <= MEMORY_DB_THRESHOLD and hasattr(sqlite3.Connection, "deserialize"):
+                    data = await resp.read()
+                    conn = await loop.run_in_executor(executor, cls._deserialize, data)
+                    digest = await loop.run_in_executor(executor, lambda: hashlib.sha256(data).hexdigest())
+                    return cls(executor, conn, digest)
+
+                digest = hashlib.sha256()
+                fd, path = tempfile.mkstemp(prefix="dragorydb-", suffix=".sqlite")
+                with os.fdopen(fd, "wb") as f:
+                    async for chunk in resp.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                        await loop.run_in_executor(executor, cls._write_chunk, f, digest, chunk)
+            conn = await loop.run_in_executor(executor, sqlite3.connect, path)
+            return cls(executor, conn, digest.hexdigest(), path)
+        except BaseException:
+            if path is not None:
+                os.remove(path)
+            executor.shutdown(wait=False)
+            raise
+
+    @staticmethod
+    def _write_chunk(f, digest, chunk):
+        f.write(chunk)
+        digest.update(chunk)
+
+    @staticmethod
+    def _deserialize(data):
+        conn = sqlite3.connect(":memory:")
+        conn.deserialize(data)
+        return conn
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    async def fetchall(self, query, params=()):
+        return await self._run(lambda: self.conn.execute(query, params).fetchall())
+
+    async def iterate(self, query, params=(), size=500):
+        """Yields rows of `query`, fetching `size` rows at a time off the event loop"""
+        cursor = await self._run(self.conn.execute, query, params)
+        try:
+            while True:
+                rows = await self._run(cursor.fetchmany, size)
+                if not rows:
+                    return
+                for row in rows:
+                    yield row
+        finally:
+            await self._run(cursor.close)
+
+    @staticmethod
+    def _thread_filter(after, since):
+        conditions, params = [], []
+        if after is not None:
+            conditions.append("id > ?")
+            params.append(after)
+        if since is not None:
+            conditions.append("created_at > ?")
+            params.append(since)
+        return f"WHERE {' AND '.join(conditions)}" if conditions else "", params
+
+    async def count_threads(self, after=None, since=None):
+        where, params = self._thread_filter(after, since)
+        return (await self.fetchall(f"SELECT COUNT(*) FROM 'threads' {where}", params))[0][0]
+
+    async def iter_threads(self, after=None, since=None):
+        """Yields every thread row along with its message rows
+
+        Both tables are read in a single ordered scan and merged, instead of querying messages per thread
+        `after` skips threads up to and including that thread id, `since` skips threads created before it
+        """
+        where, params = self._thread_filter(after, since)
+        messages = self.iterate(
+            f"SELECT * FROM 'thread_messages' WHERE thread_id IN (SELECT id FROM 'threads' {where}) "
+            "ORDER BY thread_id, created_at",
+            params,
+        )
+        try:
+            pending = await anext(messages, None)
+            async for thread in self.iterate(f"SELECT * FROM 'threads' {where} ORDER BY id", params):
+                thread_messages = []
+                if thread[0] is not None:
+                    # messages which belong to a thread that doesn't exist
+                    while pending is not None and pending[1] < thread[0]:
+                        pending = await anext(messages, None)
+                    while pending is not None and pending[1] == thread[0]:
+                        thread_messages.append(pending)
+                        pending = await anext(messages, None)
+                yield thread, thread_messages
+        finally:
+            await messages.aclose()
+
+    async def user_ids(self):
+        """Every distinct user id referenced by threads and messages"""
+        rows = await self.fetchall("SELECT user_id FROM 'threads' UNION SELECT user_id FROM 'thread_messages'")
+        return {int(row[0]) for row in rows if row[0]}
+
+    async def count(self, table):
+        return (await self.fetchall(f"SELECT COUNT(*) FROM '{table}'"))[0][0]
+
+    async def user_names(self):
+        """(user_id, user_name) pairs of everyone who sent a thread message"""
+        return await self.fetchall(
+            "SELECT DISTINCT user_id, user_name FROM 'thread_messages' WHERE user_id IS NOT NULL AND user_name IS NOT NULL"
+        )
+
+    async def close(self):
+        await self._run(self.conn.close)
+        self.executor.shutdown(wait=False)
+        if self.path is not None:
+            os.remove(self.path)
+
+
+def get_user(bot, user_id):
+    """Gets a user from the bot or USER_CACHE, this never hits the api so users have to be prefetched"""
+    if not user_id:
+        return None
+    user = bot.get_user(int(user_id))
+    if user is not None:
+        return CachedUser.from_user(user)
+    return USER_CACHE.get(int(user_id))
+
+
+async def build_name_index(bot, db):
+    """Maps name#discriminator to users, built once per migration
+
+    Users the bot can see take priority, anyone else is found through the Dragory `user_name` column
+    """
+    names = {str(user): CachedUser.from_user(user) for user in bot.users}
+    for user_id, user_name in await db.user_names():
+        if user_name not in names:
+            user = get_user(bot, user_id)
+            if user is not None:
+                names[user_name] = user
+    return names
+
+
+class BotUsers:
+    """User lookups for conversion inside the bot process"""
+
+    def __init__(self, bot, names):
+        self.bot = bot
+        self.names = names  # name#discriminator -> CachedUser
+
+    def get(self, user_id):
+        return get_user(self.bot, user_id)
+
+    def find(self, name):
+        return self.names.get(name)
+
+
+class PlaceholderUsers(BotUsers):
+    """User lookups that never fail, used to measure conversion without fetching anyone"""
+
+    def get(self, user_id):
+        if not user_id:
+            return None
+        return super().get(user_id) or CachedUser(int(user_id), "Unknown", "0000", "")
+
+
+class UserSnapshot:
+    """Picklable user lookups for conversion inside a worker process
+
+    Only the users of a chunk are pickled with it, the name index is sent once per worker by `init_worker`
+    """
+
+    __slots__ = ("users", "names")
+
+    def __init__(self, users, names=None):
+        self.users = users  # user id -> CachedUser or None
+        self.names = names  # name#discriminator -> CachedUser
+
+    def get(self, user_id):
+        if not user_id:
+            return None
+        return self.users.get(int(user_id))
+
+    def find(self, name):
+        return self.names.get(name)
+
+
+class UserPrefetcher:
+    """Resolves users into USER_CACHE through a limited amount of concurrent workers
+
+    Rate limits and server errors are retried with an exponential backoff
+    """
+
+    def __init__(self, bot, concurrency=PREFETCH_CONCURRENCY, retries=PREFETCH_RETRIES):
+        self.bot = bot
+        self.concurrency = concurrency
+        self.retries = retries
+
+        self.fetched = 0
+        self.not_found = 0
+        self.failed: list[int] = []
+
+    async def prefetch(self, user_ids):
+        pending = asyncio.Queue()
+        for user_id in user_ids:
+            if self.bot.get_user(user_id) is None and user_id not in USER_CACHE:
+                pending.put_nowait(user_id)
+
+        workers = [asyncio.create_task(self._worker(pending)) for _ in range(min(self.concurrency, pending.qsize()))]
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            for worker in workers:
+                worker.cancel()
+
+    async def _worker(self, pending):
+        while not pending.empty():
+            user_id = pending.get_nowait()
+            try:
+                USER_CACHE[user_id] = await self._fetch(user_id)
+            except discord.NotFound:
+                USER_CACHE[user_id] = None
+                self.not_found += 1
+            except (discord.HTTPException, discord.RateLimited):
+                self.failed.append(user_id)
+            else:
+                self.fetched += 1
+
+    async def _fetch(self, user_id):
+        for attempt in range(self.retries):
+            try:
+                return await self.bot.fetch_user(user_id)
+            except discord.RateLimited as e:
+                if attempt + 1 == self.retries:
+                    raise
+                await asyncio.sleep(e.retry_after)
+            except discord.HTTPException as e:
+                if attempt + 1 == self.retries or (e.status != 429 and e.status < 500):
+                    raise
+                await asyncio.sleep(2 ** attempt)
 
 
 class Thread:
     statuses = {1: "open", 2: "closed", 3: "suspended"}
 
     __slots__ = [
-        "bot",
+        "guild_id",
         "id",
         "status",
         "recipient",
@@ -34,7 +436,7 @@ class Thread:
     ]
 
     @classmethod
-    async def from_data(cls, bot, data, cursor):
+    def from_data(cls, guild_id, data, messages, users):
         # id
         # status
         # is_legacy
@@ -48,25 +450,11 @@ class Thread:
         # alert_id
 
         self = cls()
-        self.bot = bot
+        self.guild_id = guild_id
         self.id = data[0]
         self.status = self.statuses[data[1]]
 
-        user_id = data[3]
-        if user_id:
-            self.recipient = bot.get_user(int(user_id))
-            if self.recipient is None:
-                try:
-                    if int(user_id) in USER_CACHE:
-                        user = USER_CACHE[int(user_id)]
-                        self.recipient = user
-                    else:
-                        self.recipient = await bot.fetch_user(int(user_id))
-                        USER_CACHE[int(user_id)] = self.recipient
-                except discord.NotFound:
-                    self.recipient = None
-        else:
-            self.recipient = None
+        self.recipient = users.get(data[3])
 
         self.creator = self.recipient
         self.creator_mod = False
@@ -83,22 +471,18 @@ class Thread:
         self.messages = []
 
         if self.id:
-            for i in cursor.execute(
-                    "SELECT * FROM 'thread_messages' WHERE thread_id == ?", (self.id,)
-            ):
-                message = await ThreadMessage.from_data(bot, i)
+            for i in messages:
+                message = ThreadMessage.from_data(i, users)
                 if message.type_ == "command" and "close" in message.body:
                     self.closer = message.author
                 elif message.type_ == "system" and message.body.startswith(
                         "Thread was opened by "
                 ):
                     # user used the `newthread` command
-                    mod = message.body[:21]  # gets name#discrim
-                    for i in bot.users:
-                        if str(i) == mod:
-                            self.creator = i
-                            self.creator_mod = True
-                            break
+                    mod = users.find(message.body[21:].strip())  # gets name#discrim
+                    if mod is not None:
+                        self.creator = mod
+                        self.creator_mod = True
                 self.messages.append(message)
         return self
 
@@ -108,7 +492,7 @@ class Thread:
             "migrated": True,
             "open": not bool(self.closer),
             "channel_id": str(self.channel_id),
-            "guild_id": str(self.bot.guild_id),
+            "guild_id": str(self.guild_id),
             "created_at": str(self.created_at),
             "closed_at": str(self.scheduled_close_at),
             "closer": None,
@@ -116,24 +500,24 @@ class Thread:
                 "id": str(self.recipient.id),
                 "name": self.recipient.name,
                 "discriminator": self.recipient.discriminator,
-                "avatar_url": str(self.recipient.display_avatar.url),
+                "avatar_url": self.recipient.avatar_url,
                 "mod": False,
             },
             "creator": {
                 "id": str(self.creator.id),
                 "name": self.creator.name,
                 "discriminator": self.creator.discriminator,
-                "avatar_url": str(self.creator.display_avatar.url),
+                "avatar_url": self.creator.avatar_url,
                 "mod": self.creator_mod,
             },
-            "messages": [m.serialize() for m in self.messages if m.serialize()],
+            "messages": [m for m in (message.serialize() for message in self.messages) if m],
         }
         if self.closer:
             payload["closer"] = {
                 "id": str(self.closer.id),
                 "name": self.closer.name,
                 "discriminator": self.closer.discriminator,
-                "avatar_url": str(self.closer.display_avatar.url),
+                "avatar_url": self.closer.avatar_url,
                 "mod": True,
             }
         return payload
@@ -153,7 +537,6 @@ class ThreadMessage:
     }
 
     __slots__ = [
-        "bot",
         "id",
         "type_",
         "author",
@@ -166,7 +549,7 @@ class ThreadMessage:
     ]
 
     @classmethod
-    async def from_data(cls, bot, data):
+    def from_data(cls, data, users):
         # id
         # thread_id
         # message_type
@@ -178,25 +561,10 @@ class ThreadMessage:
         # created_at
 
         self = cls()
-        self.bot = bot
         self.id = data[1]
         self.type_ = self.types[data[2]]
 
-        user_id = data[3]
-        if user_id:
-            self.author = bot.get_user(int(user_id))
-            if self.author is None:
-                try:
-                    if int(user_id) in USER_CACHE:
-                        user = USER_CACHE[int(user_id)]
-                        self.author = user
-                    else:
-                        self.author = await bot.fetch_user(int(user_id))
-                        USER_CACHE[int(user_id)] = self.author
-                except discord.NotFound:
-                    self.author = None
-        else:
-            self.author = None
+        self.author = users.get(data[3])
 
         self.body = data[16]
 
@@ -224,7 +592,7 @@ class ThreadMessage:
                     "id": str(self.author.id),
                     "name": self.author.name,
                     "discriminator": self.author.discriminator,
-                    "avatar_url": str(self.author.display_avatar.url),
+                    "avatar_url": self.author.avatar_url,
                     "mod": self.type_ == "to_user",
                 }
                 if self.author
@@ -233,6 +601,152 @@ class ThreadMessage:
             }
 
 
+class LogWriter:
+    """Buffers log documents and writes them with unordered `insert_many` batches
+
+    A failed document (duplicate key or otherwise) doesn't abort the rest of its batch
+    """
+
+    def __init__(self, collection, batch_size=LOG_BATCH_SIZE, batch_bytes=LOG_BATCH_BYTES, on_flush=None):
+        self.collection = collection
+        self.batch_size = batch_size
+        self.batch_bytes = batch_bytes
+        self.buffer = []
+        self.buffer_bytes = 0
+        self.buffer_markers = []
+        self.on_flush = on_flush  # coroutine called with the markers of every document of each flushed batch, in order
+
+        self.inserted = 0
+        self.duplicates = 0
+        self.failed = 0
+        self.errors: list[tuple[str, str]] = []  # _id, error message
+
+    async def add(self, document, marker=None):
+        size = len(bson.encode(document))
+        if self.buffer and self.buffer_bytes + size > self.batch_bytes:
+            await self.flush()
+        self.buffer.append(document)
+        self.buffer_bytes += size
+        self.buffer_markers.append(marker)
+        if len(self.buffer) >= self.batch_size:
+            await self.flush()
+
+    async def flush(self):
+        if not self.buffer:
+            return
+        batch, markers = self.buffer, self.buffer_markers
+        self.buffer = []
+        self.buffer_bytes = 0
+        self.buffer_markers = []
+
+        try:
+            result = await self.collection.insert_many(batch, ordered=False)
+            self.inserted += len(result.inserted_ids)
+        except BulkWriteError as e:
+            self.inserted += e.details.get("nInserted", 0)
+            for error in e.details.get("writeErrors", []):
+                if error.get("code") == DUPLICATE_KEY_ERROR:
+                    self.duplicates += 1
+                else:
+                    self.failed += 1
+                self.errors.append((str(batch[error["index"]].get("_id")), error.get("errmsg", "Unknown error")))
+
+        if self.on_flush is not None:
+            await self.on_flush(markers)
+
+    async def close(self):
+        await self.flush()
+
+
+class MigrationReport:
+    """Migration output streamed to a temp file, with a single progress message edited on an interval"""
+
+    def __init__(self, ctx, interval=PROGRESS_INTERVAL):
+        self.ctx = ctx
+        self.interval = interval
+        fd, self.path = tempfile.mkstemp(prefix="dragory-migrate-", suffix=".txt")
+        self.file = os.fdopen(fd, "w", encoding="utf-8")
+
+        self.message = None
+        self.total = 0
+        self.started = time.monotonic()
+        self.last_edit = 0.0
+        self.edit_task = None
+
+    def write(self, line):
+        self.file.write(line + "\n")
+
+    async def status(self, description):
+        embed = discord.Embed(color=self.ctx.bot.main_color, description=description)
+        if self.message is None:
+            self.message = await self.ctx.send(embed=embed)
+        else:
+            await self._edit(embed)
+
+    async def start(self, total):
+        self.total = total
+        self.started = self.last_edit = time.monotonic()
+        await self.status(f"Migrating {total} threads")
+
+    def progress(self, done, failed):
+        """Schedules a progress edit unless one was made within the interval or is still running"""
+        now = time.monotonic()
+        if now - self.last_edit < self.interval or (self.edit_task is not None and not self.edit_task.done()):
+            return
+        self.last_edit = now
+
+        rate = done / (now - self.started) if now > self.started else 0
+        eta = f"{(self.total - done) / rate:.0f}s" if rate else "unknown"
+        embed = discord.Embed(
+            color=self.ctx.bot.main_color,
+            description=f"Migrated {done}/{self.total} threads ({rate:.0f}/s), {failed} failed, ETA {eta}",
+        )
+        self.edit_task = asyncio.create_task(self._edit(embed))
+
+    async def _edit(self, embed):
+        try:
+            await self.message.edit(embed=embed)
+        except discord.HTTPException:
+            pass
+
+    async def finish(self, content):
+        if self.edit_task is not None:
+            await self.edit_task
+        self.file.close()
+        try:
+            await self.ctx.send(content, file=discord.File(self.path, filename="output.txt"))
+        finally:
+            os.remove(self.path)
+
+
+def log_key(thread_id):
+    """Log key for a Dragory thread, the same thread always gets the same key so re-runs can't duplicate logs"""
+    return hashlib.sha256(f"dragory:{thread_id}".encode()).hexdigest()[:12]
+
+
+def convert_thread(guild_id, row, messages, users):
+    """Converts a thread row and its message rows into a log document"""
+    converted = Thread.from_data(guild_id, row, messages, users).serialize()
+    converted["key"] = converted["_id"] = log_key(row[0])
+    return converted
+
+
+# Name index of the worker process, set once by init_worker
+WORKER_NAMES: dict = {}
+
+
+def init_worker(names):
+    global WORKER_NAMES
+    WORKER_NAMES = names
+
+
+def convert_chunk(guild_id, chunk, users):
+    """Runs in a worker process, returns (document, (thread id, created_at)) for every thread in the chunk"""
+    if users.names is None:
+        users.names = WORKER_NAMES
+    return [(convert_thread(guild_id, row, messages, users), (row[0], row[6])) for row, messages in chunk]
+
+
 class DragoryMigrateRemux(commands.Cog):
     """
     Cog that migrates thread logs from [Dragory's](https://github.com/dragory/modmailbot) 
@@ -242,51 +756,130 @@ class DragoryMigrateRemux(commands.Cog):
 
     def __init__(self, bot):
         self.bot = bot
-        self.output = ""
+        self.db = bot.api.get_plugin_partition(self)
 
     @commands.command()
     @commands.is_owner()
-    async def migratedb(self, ctx, url=None):
+    async def migratedb(self, ctx, *args):
         """Migrates a database file to the mongo db.
         
         Provide an sqlite file as the attachment or a url 
         pointing to the sqlite db.
+        An interrupted migration of the same file resumes where it stopped.
+
+        Usage: `migratedb [url] [--delta] [--processes] [--dry-run]`
+        `--delta` only imports threads newer than the last migration
+        `--processes` converts threads in a pool of worker processes
+        `--dry-run` only reports what a migration would do, nothing is written
         """
 
-        self.output = ""
+        url = next((arg for arg in args if not arg.startswith("--")), None)
+        delta = "--delta" in args
+        processes = "--processes" in args
+        dry_run = "--dry-run" in args
         try:
             url = url or ctx.message.attachments[0].url
         except IndexError:
-            await ctx.send("Provide an sqlite file as the attachment.")
-
-        async with self.bot.session.get(url) as resp:
-            # TODO: use BytesIO or sth
-            with open("dragorydb.sqlite", "wb+") as f:
-                f.write(await resp.read())
-
-        conn = sqlite3.connect("dragorydb.sqlite")
-        c = conn.cursor()
+            return await ctx.send("Provide an sqlite file as the attachment.")
 
-        # Blocked Users
-        for row in c.execute("SELECT * FROM 'blocked_users'"):
+        report = MigrationReport(ctx)
+        try:
+            await report.status("Downloading database")
+            db = await DragoryDatabase.download(self.bot.session, url)
+            try:
+                if dry_run:
+                    await self._estimate(db, report)
+                else:
+                    await self._migrate(db, report, delta, processes)
+            finally:
+                await db.close()
+        except Exception:
+            await report.finish("Migration failed, Log output")
+            raise
+        await report.finish("Done!, Log output")
+
+    async def _estimate(self, db, report):
+        """Counts everything a migration would import and measures conversion on a sample of threads"""
+        threads = await db.count("threads")
+        report.write(f"Threads: {threads}")
+        report.write(f"Messages: {await db.count('thread_messages')}")
+        report.write(f"Snippets: {await db.count('snippets')}")
+        report.write(f"Blocked users: {await db.count('blocked_users')}")
+
+        if USER_CACHE_SNAPSHOT:
+            await asyncio.to_thread(USER_CACHE.load, USER_CACHE_SNAPSHOT)
+        user_ids = await db.user_ids()
+        fetches = sum(1 for user_id in user_ids if self.bot.get_user(user_id) is None and user_id not in USER_CACHE)
+        report.write(f"Users: {len(user_ids)}, {fetches} need to be fetched")
+
+        users = PlaceholderUsers(self.bot, await build_name_index(self.bot, db))
+        sampled, elapsed, size = 0, 0.0, 0
+        sample = db.iter_threads()
+        try:
+            async for row, messages in sample:
+                start = time.perf_counter()
+                converted = convert_thread(self.bot.guild_id, row, messages, users)
+                elapsed += time.perf_counter() - start
+                size += len(bson.encode(converted))
+                sampled += 1
+                if sampled >= DRY_RUN_SAMPLE:
+                    break
+        finally:
+            await sample.aclose()
+        if not sampled:
+            return
+
+        # fetches are estimated from the gateway latency as that is the closest thing to a request round trip
+        fetch_time = fetches / PREFETCH_CONCURRENCY * max(self.bot.latency, 0.05)
+        convert_time = elapsed / sampled * threads
+        report.write(f"Conversion: {sampled / elapsed if elapsed else 0:.0f} threads/s over {sampled} threads")
+        report.write(f"Projected log size: {size / sampled * threads / 1024 / 1024:.1f} MiB ({size / sampled / 1024:.1f} KiB per log)")
+        report.write(f"Projected time: {fetch_time + convert_time:.0f}s ({fetch_time:.0f}s fetching users, {convert_time:.0f}s converting)")
+
+    async def _migrate(self, db, report, delta=False, processes=False):
+        # Resolve every user up front so conversion never waits on the api
+        user_ids = await db.user_ids()
+        USER_CACHE.pin(user_ids)
+        try:
+            await self._migrate_pinned(db, report, user_ids, delta, processes)
+        finally:
+            USER_CACHE.unpin()
+
+    async def _migrate_pinned(self, db, report, user_ids, delta, processes):
+        await report.status(f"Fetching {len(user_ids)} users")
+        if USER_CACHE_SNAPSHOT:
+            loaded = await asyncio.to_thread(USER_CACHE.load, USER_CACHE_SNAPSHOT)
+            report.write(f"Loaded {loaded} users from {USER_CACHE_SNAPSHOT}")
+        prefetcher = UserPrefetcher(self.bot)
+        await prefetcher.prefetch(user_ids)
+        if USER_CACHE_SNAPSHOT:
+            await asyncio.to_thread(USER_CACHE.save, USER_CACHE_SNAPSHOT)
+        report.write(f"Fetched {prefetcher.fetched} users, {prefetcher.not_found} not found, {len(prefetcher.failed)} failed")
+        for user_id in prefetcher.failed:
+            report.write(f"Failed to fetch user {user_id}")
+
+        # Blocked Users, written straight into the config which is saved once with the snippets
+        blocked = 0
+        for row in await db.fetchall("SELECT * FROM 'blocked_users'"):
             # user_id
             # user_name
             # blocked_by
             # blocked_at
 
-            user_id = row[0]
-
-            cmd = self.bot.get_command("block")
+            user_id, user_name, blocked_by, blocked_at = row[:4]
+            if not user_id:
+                continue
+            if str(user_id) in self.bot.blocked_users:
+                report.write(f"User {user_name} ({user_id}) is already blocked")
+                continue
 
-            if int(user_id) in USER_CACHE:
-                user = USER_CACHE[int(user_id)]
-            else:
-                user = await self.bot.fetch_user(int(user_id))
-                USER_CACHE[int(user_id)] = user
-            self.bot.loop.create_task(ctx.invoke(cmd, user=user))
+            self.bot.blocked_users[str(user_id)] = f"Migrated from Dragory, blocked by {blocked_by} at {blocked_at}"
+            report.write(f"Blocked user {user_name} ({user_id})")
+            blocked += 1
+        report.write(f"Blocked {blocked} users")
 
         # Snippets
-        for row in c.execute("SELECT * FROM 'snippets'"):
+        for row in await db.fetchall("SELECT * FROM 'snippets'"):
             # trigger	body	created_by	created_at
             name = row[0]
             value = row[1]
@@ -295,33 +888,122 @@ class DragoryMigrateRemux(commands.Cog):
                 self.bot.config["snippets"] = {}
 
             self.bot.config.snippets[name] = value
-            self.output += f"Snippet {name} added: {value}\n"
+            report.write(f"Snippet {name} added: {value}")
+
+        await self.bot.config.update()
 
         prefix = self.bot.config["log_url_prefix"]
         if prefix == "NONE":
             prefix = ""
 
-        async def convert_thread_log(row):
-            thread = await Thread.from_data(self.bot, row, c)
-            converted = thread.serialize()
-            key = secrets.token_hex(6)
-            converted["key"] = key
-            converted["_id"] = key
-            await self.bot.db.logs.insert_one(converted)
-            log_url = f"{self.bot.config['log_url']}{prefix}/{key}"
-            print(f"Posted thread log: {log_url}")
-            self.output += f"Posted thread log: {log_url}\n"
+        checkpoint = await self.db.find_one({"_id": "migration"}) or {}
+        if checkpoint.get("source") == db.digest and not checkpoint.get("completed", True):
+            since, after, watermark = checkpoint.get("since"), checkpoint.get("last_thread_id"), checkpoint.get("watermark")
+            report.write(f"Resuming migration after thread {after}")
+        elif delta:
+            since, after, watermark = checkpoint.get("watermark"), None, checkpoint.get("watermark")
+            report.write(f"Importing threads created after {since}")
+        else:
+            since, after, watermark = None, None, None
+
+        last_thread_id = after
+
+        async def save_checkpoint(markers, completed=False):
+            nonlocal last_thread_id, watermark
+            # threads are read in id order, not by time, so the watermark is the newest of every written thread
+            for thread_id, created_at in markers:
+                last_thread_id = thread_id
+                if watermark is None or created_at > watermark:
+                    watermark = created_at
+            await self.db.find_one_and_update(
+                {"_id": "migration"},
+                {
+                    "$set": {
+                        "source": db.digest,
+                        "since": since,
+                        "last_thread_id": last_thread_id,
+                        "watermark": watermark,
+                        "completed": completed,
+                    }
+                },
+                upsert=True,
+            )
+
+        writer = LogWriter(self.bot.db.logs, on_flush=save_checkpoint)
+
+        done = 0
+
+        async def write_thread_log(converted, marker):
+            nonlocal done
+            await writer.add(converted, marker=marker)
+            done += 1
+            report.write(f"Posted thread log: {self.bot.config['log_url']}{prefix}/{converted['key']}")
+            report.progress(done, writer.duplicates + writer.failed)
 
         # Threads
-        for row in c.execute("SELECT * FROM 'threads'"):
-            await convert_thread_log(row)
-
-        await self.bot.config.update()
-        conn.close()
-        os.remove("dragorydb.sqlite")
+        names = await build_name_index(self.bot, db)
+        await report.start(await db.count_threads(after=after, since=since))
+        threads = db.iter_threads(after=after, since=since)
+        # closed before db.close() shuts down the executor their cursors are closed on
+        try:
+            if processes:
+                converted_threads = self._convert_in_processes(threads, names)
+                try:
+                    async for converted, marker in converted_threads:
+                        await write_thread_log(converted, marker)
+                finally:
+                    await converted_threads.aclose()
+            else:
+                users = BotUsers(self.bot, names)
+                async for row, messages in threads:
+                    await write_thread_log(convert_thread(self.bot.guild_id, row, messages, users), (row[0], row[6]))
+        finally:
+            await threads.aclose()
+        await writer.close()
+        await save_checkpoint([], completed=True)
+
+        report.write(f"Inserted {writer.inserted} thread logs, {writer.duplicates} duplicates, {writer.failed} failed")
+        for key, error in writer.errors:
+            report.write(f"Failed to insert thread log {key}: {error}")
+
+    async def _convert_in_processes(self, threads, names):
+        """Converts threads in chunks on a process pool, yielding results in order
+
+        Users are resolved here and handed to the workers so they never need the bot
+        """
+        loop = asyncio.get_running_loop()
+        workers = os.cpu_count() or 1
+        # never fork the running bot, its executor and database client threads would be copied mid use
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+        pool = ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=init_worker, initargs=(names,))
+        in_flight = deque()
+
+        def submit(chunk):
+            user_ids = set()
+            for row, messages in chunk:
+                user_ids.update(int(data[3]) for data in (row, *messages) if data[3])
+            users = UserSnapshot({user_id: get_user(self.bot, user_id) for user_id in user_ids})
+            in_flight.append(loop.run_in_executor(pool, convert_chunk, self.bot.guild_id, chunk, users))
 
-        bytes_io = BytesIO(self.output.encode('utf-8'))
-        await ctx.send("Done!, Log output", file=discord.File(fp=bytes_io, filename='output.txt'))
+        try:
+            chunk = []
+            async for row, messages in threads:
+                chunk.append((row, messages))
+                if len(chunk) >= PROCESS_CHUNK_SIZE:
+                    submit(chunk)
+                    chunk = []
+                    # keep every worker busy without buffering the whole database
+                    if len(in_flight) > workers * 2:
+                        for result in await in_flight.popleft():
+                            yield result
+            if chunk:
+                submit(chunk)
+            while in_flight:
+                for result in await in_flight.popleft():
+                    yield result
+        finally:
+            pool.shutdown(wait=False, cancel_futures=True)
 
 
 async def setup(bot):
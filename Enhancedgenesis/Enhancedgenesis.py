@@ -1,9 +1,25 @@
+import asyncio
+import time
+import statistics
+import typing
+from collections import deque
 from datetime import datetime, timezone
 
+import discord
+from core import checks
+from core.models import getLogger, PermissionLevel
 from core.thread import Thread
 from core.utils import days
 from discord.ext import commands
 from discord.utils import snowflake_time
+from pymongo.errors import PyMongoError
+
+provider_timeout = 2  # seconds a provider gets before the genesis message is edited without it
+patch_timeout = 30  # seconds late providers may still finish in to be added with a second edit
+latency_samples = 100  # latencies kept per provider
+
+# Called with the thread, returns a line for the genesis embed or None to add nothing
+Provider = typing.Callable[[Thread], typing.Awaitable[typing.Optional[str]]]
 
 
 class Enhancedgenesisplugin(commands.Cog):
@@ -11,44 +27,134 @@ class Enhancedgenesisplugin(commands.Cog):
 
     def __init__(self, bot):
         self.bot = bot
+        self.logger = getLogger("Enhancedgenesis")
+        self.providers: list[tuple[str, Provider, float]] = []
+        self.latencies: dict[str, deque] = {}  # provider name -> recent latencies in seconds
 
-    # Rewrite genesis message to be formated better
-    @commands.Cog.listener()
-    async def on_thread_ready(self, thread: Thread, creator, category, initial_message):
-        # Grab older embed data from msg (only change description)
+        self.add_provider("joined", self.joined_line)
+        self.add_provider("threads", self.threads_line)
+
+    async def cog_load(self):
+        # Covers the closed thread count below, without it mongo scans every log of the recipient
         try:
-            genesis_message = await thread.get_genesis_message()
-            if not genesis_message:
-                return
-            embed = genesis_message.embeds[0]
-        except Exception:
-            raise Exception("Message doesn't have an embed/genesis doesn't exist")
+            await self.bot.db.logs.create_index(
+                [("recipient.id", 1), ("guild_id", 1), ("open", 1)], name="enhancedgenesis_closed_threads"
+            )
+        except PyMongoError:
+            self.logger.warning("Failed to create the closed thread count index", exc_info=True)
+
+    def add_provider(self, name: str, provider: Provider, timeout: float = provider_timeout):
+        """Adds a line to the genesis embed, lines are shown in the order their providers were added"""
+        self.providers.append((name, provider, timeout))
+        self.latencies.setdefault(name, deque(maxlen=latency_samples))
+
+    async def closed_thread_count(self, user_id) -> int:
+        return await self.bot.db.logs.count_documents(
+            {"recipient.id": str(user_id), "guild_id": str(self.bot.guild_id), "open": False}
+        )
 
+    async def joined_line(self, thread: Thread) -> typing.Optional[str]:
         member = self.bot.guild.get_member(thread._recipient.id)
-        time = datetime.utcnow().replace(tzinfo=timezone.utc)
-        created = str((time - thread._recipient.created_at).days)
+        if member is None:
+            try:
+                member = await self.bot.guild.fetch_member(thread._recipient.id)
+            except discord.NotFound:
+                return None
+        if member.joined_at is None:
+            return None
+        now = datetime.utcnow().replace(tzinfo=timezone.utc)
+        return f"**Joined:** {days(str((now - member.joined_at).days))} (<t:{member.joined_at.strftime('%s')}>)"
+
+    async def threads_line(self, thread: Thread) -> typing.Optional[str]:
+        log_count = await self.closed_thread_count(thread._recipient.id)
+        if not log_count:
+            return None
+        thread_word = "Thread" if log_count == 1 else "Threads"
+        return f"**{thread_word} Created:** {str(log_count)}"
+
+    async def _run(self, name: str, provider: Provider, thread: Thread) -> typing.Optional[str]:
+        start = time.perf_counter()
+        try:
+            return await provider(thread)
+        except Exception:
+            # a failing provider only loses its own line
+            self.logger.warning(f"Genesis provider {name} failed", exc_info=True)
+            return None
+        finally:
+            elapsed = time.perf_counter() - start
+            self.latencies[name].append(elapsed)
+            self.logger.debug(f"Genesis provider {name} took {elapsed * 1000:.0f}ms")
+
+    def _describe(self, thread: Thread, tasks: list[tuple[str, asyncio.Task]]) -> str:
+        now = datetime.utcnow().replace(tzinfo=timezone.utc)
+        created = str((now - thread._recipient.created_at).days)
 
         embed_description = []
         embed_description.append(f"**Profile:** {thread._recipient.mention}")
-
         embed_description.append(f"**Created:** {days(created)} (<t:{snowflake_time(thread._recipient.id).strftime('%s')}>)")
 
-        if member is not None and member.joined_at is not None:
-            embed_description.append(f"**Joined:** {days(str((time - member.joined_at).days))} (<t:{member.joined_at.strftime('%s')}>)")
+        for _, task in tasks:
+            if task.done() and not task.cancelled() and task.result():
+                embed_description.append(task.result())
+        return "\n".join(embed_description)
 
-        Logs = await self.bot.api.get_user_logs(thread._recipient.id)
-        log_count = 0
-        for log in Logs:
-            if not log['open']:
-                log_count += 1
+    # Rewrite genesis message to be formated better
+    @commands.Cog.listener()
+    async def on_thread_ready(self, thread: Thread, creator, category, initial_message):
+        # Providers start before the genesis message is fetched and each gets its own deadline
+        start = time.monotonic()
+        tasks = [(name, asyncio.create_task(self._run(name, provider, thread))) for name, provider, _ in self.providers]
+        deadlines = [start + timeout for _, _, timeout in self.providers]
 
-        if log_count:
-            thread_word = "Thread" if log_count == 1 else "Threads"
-            embed_description.append(f"**{thread_word} Created:** {str(log_count)}")
+        try:
+            genesis_message = await thread.get_genesis_message()
+        except discord.HTTPException:
+            genesis_message = None
+        # Grab older embed data from msg (only change description)
+        if not genesis_message or not genesis_message.embeds:
+            self.logger.warning(f"Genesis message of thread {thread.id} doesn't exist or has no embed")
+            for _, task in tasks:
+                task.cancel()
+            return
+        embed = genesis_message.embeds[0]
+
+        for (_, task), deadline in sorted(zip(tasks, deadlines), key=lambda item: item[1]):
+            remaining = deadline - time.monotonic()
+            if not task.done() and remaining > 0:
+                await asyncio.wait([task], timeout=remaining)
 
-        embed.description = "\n".join(embed_description)
+        embed.description = self._describe(thread, tasks)
         await genesis_message.edit(content=genesis_message.content, embed=embed)
 
+        pending = [task for _, task in tasks if not task.done()]
+        if not pending:
+            return
+        # Second edit with the providers that finished late
+        done, pending = await asyncio.wait(pending, timeout=patch_timeout)
+        for task in pending:
+            task.cancel()
+        if any(task.result() for task in done):
+            embed.description = self._describe(thread, tasks)
+            await genesis_message.edit(content=genesis_message.content, embed=embed)
+
+    @commands.command()
+    @checks.has_permissions(PermissionLevel.ADMIN)
+    async def genesisstats(self, ctx):
+        """Shows how long each genesis provider took over its recent runs
+
+        Usage: `genesisstats`
+        """
+        rows = []
+        for name, _, timeout in self.providers:
+            samples = self.latencies[name]
+            if not samples:
+                rows.append(f"**{name}:** no runs yet")
+                continue
+            late = sum(1 for sample in samples if sample > timeout)
+            rows.append(f"**{name}:** p50 {statistics.median(samples) * 1000:.0f}ms, max {max(samples) * 1000:.0f}ms, "
+                        f"{late}/{len(samples)} over the {timeout}s timeout")
+        return await ctx.send(embed=discord.Embed(color=self.bot.main_color, description="\n".join(rows) or "No providers"))
+
 
 async def setup(bot):
     await bot.add_cog(Enhancedgenesisplugin(bot))
@@ -1,12 +1,210 @@
 import asyncio
+import copy
+import re
+import time
+import typing
 
 import discord
 from discord.ext import commands
+from pymongo import ReturnDocument
 
 from core import checks
 from core.models import getLogger, PermissionLevel
 
 
+# modmail keeps the recipients of a thread in its channel topic
+uid_regex = re.compile(r"\bUser ID:\s*(\d{17,21})\b", flags=re.IGNORECASE)
+other_recipients_regex = re.compile(r"\bOther Recipients:\s*((?:\d{17,21}\s*,?\s*)+)", flags=re.IGNORECASE)
+snowflake_regex = re.compile(r"\d{17,21}")
+
+config_write_delay = 2  # seconds config changes are held for before being written as one update
+config_poll_interval = 30  # seconds between checks for config changes made by other bot instances
+
+
+class ConfigStore(object):
+    """
+    Versioned snapshot of the plugin config document
+
+    Writes are coalesced into a single `$set` of the changed fields, every write bumps `version`
+    so other bot instances sharing the database notice the change from a cheap poll and reload.
+    """
+
+    def __init__(self, db, on_load, logger, delay=config_write_delay, poll_interval=config_poll_interval):
+        self.db = db
+        self.on_load = on_load  # called with the config document (or None) whenever a new snapshot is loaded
+        self.logger = logger
+        self.delay = delay
+        self.poll_interval = poll_interval
+        self.values: dict = {}
+        self.saved: dict = {}  # values as they are in the db
+        self.version = 0
+        self.loaded = False  # nothing is written before the stored config has been read once
+        self.dirty: set[str] = set()
+        self.lock = asyncio.Lock()
+        self.ready = asyncio.Event()
+        self.flush_task: typing.Optional[asyncio.Task] = None
+        self.watcher: typing.Optional[asyncio.Task] = None
+
+    def start(self):
+        self.watcher = asyncio.create_task(self._watch())
+
+    async def load(self):
+        async with self.lock:
+            if self.loaded and self.dirty:
+                return  # staged changes would be dropped, the next poll after they are written reloads
+            config = await self.db.find_one({"_id": "config"})
+            if config is not None:
+                config.pop("_id")
+                self.version = config.pop("version", 0)
+                self.values = config
+                self.saved = copy.deepcopy(config)
+            self.loaded = True
+        await self.on_load(config)
+
+    async def _watch(self):
+        # retried until it succeeds, events and commands wait on `ready` rather than running on the defaults
+        attempt = 0
+        while not self.loaded:
+            try:
+                await self.load()
+            except Exception:
+                self.logger.warning("Failed to load the config, retrying", exc_info=True)
+                await asyncio.sleep(min(2 ** attempt, self.poll_interval))
+                attempt += 1
+        self.ready.set()
+
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            if self.dirty:
+                continue  # reloaded once our own changes are written
+            try:
+                data = await self.db.find_one({"_id": "config"}, {"version": 1})
+                if data is not None and data.get("version", 0) != self.version:
+                    self.logger.debug("Config changed by another instance, reloading")
+                    await self.load()
+            except Exception:
+                self.logger.warning("Failed to poll the config", exc_info=True)
+
+    def update(self, values: dict):
+        """Stages `values` and schedules a write, lists/dicts mutated in place are picked up when flushing"""
+        self.values.update(values)
+        self.dirty.update(values.keys())
+        if self.flush_task is None or self.flush_task.done():
+            self.flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        # keeps going while changes come in during a write, those would otherwise wait for the next update
+        while self.dirty:
+            await asyncio.sleep(self.delay)
+            await self.flush()
+
+    async def flush(self):
+        if not self.loaded:
+            return  # the defaults would overwrite the stored config, kept in `dirty` until it is loaded
+        async with self.lock:
+            dirty, self.dirty = self.dirty, set()
+            changed = {key: self.values[key] for key in dirty if key in self.values and self.saved.get(key, ...) != self.values[key]}
+            if not changed:
+                return
+
+            try:
+                data = await self.db.find_one_and_update(
+                    {"_id": "config"},
+                    {"$set": changed, "$inc": {"version": 1}},
+                    {"version": 1},
+                    upsert=True,
+                    return_document=ReturnDocument.AFTER,
+                )
+            except BaseException:
+                # also on cancellation, the keys were already taken out of `dirty`
+                self.dirty |= dirty
+                raise
+            self.saved.update(copy.deepcopy(changed))
+            # a skipped version means another instance wrote in between, the watcher picks up its changes
+            if data["version"] == self.version + 1:
+                self.version = data["version"]
+
+    async def close(self):
+        if self.watcher is not None:
+            self.watcher.cancel()
+        if self.flush_task is not None and not self.flush_task.done():
+            # a write in progress puts its keys back into `dirty` when cancelled, the flush below writes them
+            self.flush_task.cancel()
+            try:
+                await self.flush_task
+            except asyncio.CancelledError:
+                pass
+        await self.flush()
+
+
+member_query_size = 100  # most user ids discord accepts in a single member query
+
+status_window = 30  # seconds join/leave events of a thread are merged into the same status message
+status_rate = 5  # status sends/edits allowed per channel ...
+status_per = 5  # ... per this many seconds
+
+
+class TokenBucket(object):
+    """Spaces out sends to a channel so bursts stay under its rate limit"""
+
+    def __init__(self, capacity=status_rate, per=status_per):
+        self.capacity = capacity
+        self.rate = capacity / per
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class StatusBurst(object):
+    """Join/leave events of one thread within `status_window`, shown as a single edited embed"""
+
+    def __init__(self, channel):
+        self.channel = channel
+        self.started = time.monotonic()
+        self.events: list[tuple[discord.abc.User, discord.Guild, bool]] = []  # member, guild, joined
+        self.rendered = 0  # amount of events shown in the message
+        self.message: typing.Optional[discord.Message] = None
+        self.render_task: typing.Optional[asyncio.Task] = None
+
+    @property
+    def expired(self):
+        return time.monotonic() - self.started > status_window
+
+    @property
+    def busy(self):
+        return self.render_task is not None and not self.render_task.done()
+
+    def embed(self, bot) -> discord.Embed:
+        color = bot.main_color if self.events[-1][2] else bot.error_color
+        if len(self.events) == 1:
+            _, guild, joined = self.events[0]
+            return discord.Embed(description=f"User has {'joined' if joined else 'left'}: {guild}", color=color)
+
+        parts: dict[int, list[str]] = {}  # member id -> "joined A", "left B", ...
+        names: dict[int, str] = {}
+        seen = set()
+        for member, guild, joined in self.events:
+            verb = ("rejoined" if (member.id, guild.id) in seen else "joined") if joined else "left"
+            seen.add((member.id, guild.id))
+            parts.setdefault(member.id, []).append(f"{verb} {guild}")
+            names[member.id] = str(member)
+
+        if len(parts) == 1:
+            description = "User has " + ", ".join(next(iter(parts.values())))
+        else:
+            description = "\n".join(f"{names[member_id]} has " + ", ".join(rows) for member_id, rows in parts.items())
+        return discord.Embed(description=description, color=color)
+
+
 class Guildmemberwatch(commands.Cog):
     """Plugin to watch specific guilds users, if they made a thread show message that they joined/left the guild :)"""
 
@@ -14,53 +212,255 @@ class Guildmemberwatch(commands.Cog):
         self.bot = bot
         self.db = bot.api.get_plugin_partition(self)
         self.logger = getLogger("Guildmemberwatch")
+        self.config = ConfigStore(self.db, self._set_options, self.logger)
 
         # settings
         self.enabled = True
         self.watching_guilds: list = list()
-        asyncio.create_task(self._set_options())
+        self.watched: set[int] = set()  # watching_guilds as a set, empty while disabled
+
+        # recipient id -> channel of their open thread, so members without a thread are rejected without a lookup
+        self.thread_channels: dict[int, discord.TextChannel] = {}
+        self.channel_recipients: dict[int, set[int]] = {}  # channel id -> recipient ids, to drop a closed thread
+
+        # channel id -> status message currently collecting join/leave events, and the bucket its sends go through
+        self.bursts: dict[int, StatusBurst] = {}
+        self.buckets: dict[int, TokenBucket] = {}
+
+        # guild id -> recipient id -> whether they were in the guild when last seen, persisted so joins/leaves
+        # that happened while the bot was offline can be reported on startup
+        self.membership: dict[int, dict[int, bool]] = {}
+        self.membership_task: typing.Optional[asyncio.Task] = None
+        self.reconcile_lock = asyncio.Lock()
+        self.indexed = False
+
+        self.config.start()
+        asyncio.create_task(self._startup())
+
+    async def cog_before_invoke(self, ctx):
+        await self.config.ready.wait()
+
+    async def cog_unload(self):
+        await self.config.close()
+        if self.membership_task is not None and not self.membership_task.done():
+            self.membership_task.cancel()
+            await self._save_membership()
 
     async def _update_config(self):
-        await self.db.find_one_and_update(
-            {"_id": "config"},
+        self.config.update(
             {
-                "$set": {
-                    "enabled": self.enabled,
-                    "watching_guilds": self.watching_guilds,
-                }
-            },
-            upsert=True,
+                "enabled": self.enabled,
+                "watching_guilds": self.watching_guilds,
+            }
         )
 
-    async def _set_options(self):
-        config = await self.db.find_one({"_id": "config"})
-
+    async def _set_options(self, config: typing.Optional[dict]):
         if config is None:
             await self._update_config()
             return
 
         self.enabled = config.get("enabled", True)
         self.watching_guilds = config.get("watching_guilds", [])
+        self._update_watched()
+
+    def _update_watched(self):
+        self.watched = set(self.watching_guilds) if self.enabled else set()
+
+    async def _startup(self):
+        await self.bot.wait_until_ready()
+        # the thread index is always built, a failure here must not silently drop every join/leave
+        try:
+            data = await self.db.find_one({"_id": "membership"})
+            if data is not None:
+                self.membership = dict(
+                    (int(guild_id), dict((int(user_id), present) for (user_id, present) in users.items()))
+                    for (guild_id, users) in data.get("guilds", {}).items()
+                )
+        except Exception:
+            self.logger.warning("Failed to load the stored membership, missed joins/leaves won't be reported", exc_info=True)
+        try:
+            self._build_thread_index()
+        except Exception:
+            self.logger.error("Failed to index thread channels, only new threads are watched", exc_info=True)
+        self.indexed = True
+        try:
+            await self._reconcile()
+        except Exception:
+            self.logger.warning("Failed to reconcile membership", exc_info=True)
+
+    def _build_thread_index(self):
+        guild = self.bot.modmail_guild
+        if guild is None:
+            return
+
+        for channel in guild.text_channels:
+            if not channel.topic:
+                continue
+            match = uid_regex.search(channel.topic)
+            if not match:
+                continue
+            user_ids = [int(match.group(1))]
+            others = other_recipients_regex.search(channel.topic)
+            if others:
+                user_ids.extend(int(user_id) for user_id in snowflake_regex.findall(others.group(1)))
+            for user_id in user_ids:
+                if user_id not in self.thread_channels:
+                    self._index(user_id, channel)
+        self.logger.debug(f"Indexed {len(self.thread_channels)} thread recipients")
+
+    def _index(self, user_id, channel):
+        previous = self.thread_channels.get(user_id)
+        if previous is not None and previous.id != channel.id:
+            self.channel_recipients.get(previous.id, set()).discard(user_id)
+        self.thread_channels[user_id] = channel
+        self.channel_recipients.setdefault(channel.id, set()).add(user_id)
+
+    def _forget_channel(self, channel):
+        for user_id in self.channel_recipients.pop(channel.id, ()):
+            self.thread_channels.pop(user_id, None)
+            for users in self.membership.values():
+                users.pop(user_id, None)
+            self._schedule_membership_save()
+        self.bursts.pop(channel.id, None)
+        self.buckets.pop(channel.id, None)
+
+    def _record(self, guild_id, user_id, present):
+        users = self.membership.setdefault(guild_id, {})
+        if users.get(user_id) != present:
+            users[user_id] = present
+            self._schedule_membership_save()
+
+    def _schedule_membership_save(self):
+        if self.membership_task is None or self.membership_task.done():
+            self.membership_task = asyncio.create_task(self._save_membership_later())
+
+    async def _save_membership_later(self):
+        await asyncio.sleep(config_write_delay)
+        await self._save_membership()
+
+    async def _save_membership(self):
+        guilds = dict(
+            (str(guild_id), dict((str(user_id), present) for (user_id, present) in users.items()))
+            for (guild_id, users) in self.membership.items()
+            if users
+        )
+        await self.db.update_one({"_id": "membership"}, {"$set": {"guilds": guilds}}, upsert=True)
+
+    async def _reconcile(self):
+        """Reports joins/leaves of open thread recipients that happened while the bot wasn't receiving events"""
+        if self.reconcile_lock.locked():
+            return
+        async with self.reconcile_lock:
+            await self.config.ready.wait()
+            recipients = list(self.thread_channels)
+            for guild_id in list(self.watched):
+                guild = self.bot.get_guild(guild_id)
+                if guild is None or not recipients:
+                    continue
+                present = set()
+                try:
+                    # only the thread recipients are queried, the guild's member list is never chunked
+                    for i in range(0, len(recipients), member_query_size):
+                        chunk = recipients[i : i + member_query_size]
+                        members = await guild.query_members(user_ids=chunk, limit=len(chunk), cache=False)
+                        present.update(member.id for member in members)
+                except (discord.ClientException, asyncio.TimeoutError):
+                    self.logger.warning(f"Failed to query members of {guild} ({guild.id})", exc_info=True)
+                    continue
+
+                known = self.membership.get(guild_id, {})
+                for user_id in recipients:
+                    is_member = user_id in present
+                    channel = self.thread_channels.get(user_id)
+                    if user_id in known and known[user_id] != is_member and channel is not None:
+                        user = guild.get_member(user_id) or await self.bot.get_or_fetch_user(user_id)
+                        self.logger.info(f"{user} ({user_id}) has {'joined' if is_member else 'left'} guild {guild} ({guild.id}) while the bot was offline")
+                        self._notify(channel, user, guild, is_member)
+                    self._record(guild_id, user_id, is_member)
+
+    def _notify(self, channel, user, guild, joined):
+        burst = self.bursts.get(channel.id)
+        if burst is None or burst.expired:
+            self._prune_bursts()
+            burst = self.bursts[channel.id] = StatusBurst(channel)
+        burst.events.append((user, guild, joined))
+        if not burst.busy:
+            burst.render_task = asyncio.create_task(self._render(burst))
+
+    def _prune_bursts(self):
+        for channel_id in [channel_id for channel_id, burst in self.bursts.items() if burst.expired and not burst.busy]:
+            del self.bursts[channel_id]
+            self.buckets.pop(channel_id, None)
+
+    async def _render(self, burst):
+        bucket = self.buckets.setdefault(burst.channel.id, TokenBucket())
+        # events arriving while waiting for a token or sending are picked up by the next pass
+        while burst.rendered < len(burst.events):
+            await bucket.acquire()
+            count = len(burst.events)
+            embed = burst.embed(self.bot)
+            try:
+                if burst.message is not None:
+                    try:
+                        await burst.message.edit(embed=embed)
+                    except discord.NotFound:
+                        burst.message = None
+                if burst.message is None:
+                    burst.message = await burst.channel.send(embed=embed)
+            except discord.HTTPException:
+                self.logger.warning(f"Failed to send member status to {burst.channel} ({burst.channel.id})", exc_info=True)
+                return
+            burst.rendered = count
+
+    @commands.Cog.listener()
+    async def on_thread_ready(self, thread, creator, category, initial_message):
+        for recipient in thread.recipients:
+            self._index(recipient.id, thread.channel)
+            for guild_id in self.watched:
+                guild = self.bot.get_guild(guild_id)
+                if guild is not None and guild.chunked:
+                    self._record(guild_id, recipient.id, guild.get_member(recipient.id) is not None)
+
+    @commands.Cog.listener()
+    async def on_ready(self):
+        # a new session after a long disconnect replays nothing, compare membership again
+        if self.indexed:
+            await self._reconcile()
+
+    @commands.Cog.listener()
+    async def on_thread_close(self, thread, closer, silent, delete_channel, message, scheduled):
+        self._forget_channel(thread.channel)
+
+    @commands.Cog.listener()
+    async def on_guild_channel_delete(self, channel):
+        if isinstance(channel, discord.TextChannel):
+            self._forget_channel(channel)
 
     @commands.Cog.listener()
     async def on_member_join(self, member):
-        if member.guild.id not in self.watching_guilds:
+        if not self.config.ready.is_set():
+            await self.config.ready.wait()
+        if member.guild.id not in self.watched:
             return
-        thread = await self.bot.threads.find(recipient_id=member.id)
-        if not thread:
+        channel = self.thread_channels.get(member.id)
+        if channel is None:
             return
         self.logger.info(f"{member} ({member.id}) has joined guild {member.guild} ({member.guild.id}) with an active thread")
-        await thread.channel.send(embed=discord.Embed(description=f"User has joined: {member.guild}", color=self.bot.main_color))
+        self._record(member.guild.id, member.id, True)
+        self._notify(channel, member, member.guild, True)
 
     @commands.Cog.listener()
     async def on_member_remove(self, member):
-        if member.guild.id not in self.watching_guilds:
+        if not self.config.ready.is_set():
+            await self.config.ready.wait()
+        if member.guild.id not in self.watched:
             return
-        thread = await self.bot.threads.find(recipient_id=member.id)
-        if not thread:
+        channel = self.thread_channels.get(member.id)
+        if channel is None:
             return
         self.logger.info(f"{member} ({member.id}) has left guild {member.guild} ({member.guild.id}) with an active thread")
-        await thread.channel.send(embed=discord.Embed(description=f"User has left: {member.guild}", color=self.bot.error_color))
+        self._record(member.guild.id, member.id, False)
+        self._notify(channel, member, member.guild, False)
 
     @commands.group(name="gmw", invoke_without_command=True)
     @checks.has_permissions(PermissionLevel.OWNER)
@@ -79,6 +479,7 @@ class Guildmemberwatch(commands.Cog):
         """
 
         self.enabled = not self.enabled
+        self._update_watched()
         await self._update_config()
         embed = discord.Embed(color=self.bot.main_color)
         embed.description = "Guild member watch has been " + ("enabled" if self.enabled else "disabled")
@@ -95,6 +496,7 @@ class Guildmemberwatch(commands.Cog):
         else:
             self.watching_guilds.append(target.id)
 
+        self._update_watched()
         await self._update_config()
         return await ctx.send(embed=discord.Embed(color=self.bot.main_color, description=f"{target} ({target.id}) has been {'added' if target.id in self.watching_guilds else 'removed'}"))
 
@@ -0,0 +1,335 @@
+"""Offline benchmark for the Dragory-migrate-remux plugin
+
+Generates a Dragory schema sqlite database and runs the migration against a fake bot
+and an in memory mongo collection, no discord connection or mongo server is needed.
+
+Usage: python benchmarks/dragory_migrate.py --threads 5000 --messages 20 --users 2000 --latency 0.05
+"""
+import argparse
+import asyncio
+import importlib
+import os
+import random
+import resource
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+from pymongo.errors import BulkWriteError
+
+PLUGIN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Dragory-migrate-remux")
+
+# Column order of a Dragory database, message bodies end up last after the body column migration
+THREADS_SCHEMA = """
+CREATE TABLE threads (
+    id TEXT PRIMARY KEY, status INTEGER, is_legacy INTEGER, user_id TEXT, user_name TEXT, channel_id TEXT,
+    created_at TEXT, scheduled_close_at TEXT, scheduled_close_id TEXT, scheduled_close_name TEXT, alert_id TEXT
+)
+"""
+MESSAGES_SCHEMA = """
+CREATE TABLE thread_messages (
+    id INTEGER PRIMARY KEY, thread_id TEXT, message_type INTEGER, user_id TEXT, user_name TEXT, is_anonymous INTEGER,
+    dm_message_id TEXT, created_at TEXT, message_number INTEGER, dm_channel_id TEXT, attachments TEXT,
+    small_attachments TEXT, metadata TEXT, inbox_message_id TEXT, role_name TEXT, use_legacy_format INTEGER, body TEXT
+)
+"""
+OTHER_SCHEMA = """
+CREATE TABLE blocked_users (user_id TEXT, user_name TEXT, blocked_by TEXT, blocked_at TEXT);
+CREATE TABLE snippets (trigger TEXT, body TEXT, created_by TEXT, created_at TEXT);
+"""
+
+
+def load_plugin():
+    # imported from sys.path so spawned worker processes can import it again to unpickle the conversion functions
+    sys.path.insert(0, os.path.normpath(PLUGIN_DIR))
+    return importlib.import_module("Dragory-migrate-remux")
+
+
+def generate(path, threads, messages, users, attachment_ratio, seed=0):
+    """Writes a Dragory schema database with `threads` threads of `messages` messages each"""
+    rng = random.Random(seed)
+    conn = sqlite3.connect(path)
+    conn.executescript(THREADS_SCHEMA + ";" + MESSAGES_SCHEMA + ";" + OTHER_SCHEMA)
+    start = datetime(2020, 1, 1)
+    message_id = 0
+
+    for t in range(threads):
+        thread_id = f"{rng.getrandbits(128):032x}"
+        recipient = str(10 ** 17 + rng.randrange(users))
+        created_at = start + timedelta(minutes=t)
+        conn.execute(
+            "INSERT INTO threads VALUES (?, ?, 0, ?, ?, ?, ?, NULL, NULL, NULL, NULL)",
+            (thread_id, 2, recipient, f"user{recipient}#0001", str(10 ** 17 + t), str(created_at)),
+        )
+
+        rows = []
+        for i in range(messages):
+            if i == 0 and rng.random() < 0.1:
+                message_type, body = 1, f"Thread was opened by user{10 ** 17 + rng.randrange(users)}#0001"
+            elif i == messages - 1:
+                message_type, body = 6, "!close"
+            else:
+                message_type = rng.choice((3, 4))
+                body = "Lorem ipsum dolor sit amet " * rng.randint(1, 8)
+                if rng.random() < attachment_ratio:
+                    body += f"http://127.0.0.1:8890/attachments/{rng.getrandbits(40)}/image.png"
+            author = recipient if message_type == 3 else str(10 ** 17 + rng.randrange(users))
+            message_id += 1
+            rows.append((
+                message_id, thread_id, message_type, author, f"user{author}#0001", 0, str(message_id),
+                str(created_at + timedelta(seconds=i)), i, None, None, None, None, None, None, 0, body,
+            ))
+        conn.executemany(f"INSERT INTO thread_messages VALUES ({', '.join('?' * 17)})", rows)
+
+    for i in range(max(1, users // 100)):
+        conn.execute("INSERT INTO blocked_users VALUES (?, 'blocked#0001', '1', ?)", (str(10 ** 17 + i), str(start)))
+    conn.execute("INSERT INTO snippets VALUES ('hello', 'Hello there!', '1', ?)", (str(start),))
+    conn.commit()
+    conn.close()
+
+
+class InsertManyResult:
+    def __init__(self, inserted_ids):
+        self.inserted_ids = inserted_ids
+
+
+class MemoryCollection:
+    """The subset of a motor collection used by the plugin"""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.documents = {}
+
+    async def find_one(self, query):
+        await asyncio.sleep(self.latency)
+        return self.documents.get(query["_id"])
+
+    async def find_one_and_update(self, query, update, upsert=False):
+        await asyncio.sleep(self.latency)
+        document = self.documents.setdefault(query["_id"], {"_id": query["_id"]})
+        document.update(update.get("$set", {}))
+        return document
+
+    async def insert_many(self, documents, ordered=True):
+        await asyncio.sleep(self.latency)
+        inserted, errors = [], []
+        for index, document in enumerate(documents):
+            if document["_id"] in self.documents:
+                errors.append({"index": index, "code": 11000, "errmsg": "E11000 duplicate key error"})
+                if ordered:
+                    break
+            else:
+                self.documents[document["_id"]] = document
+                inserted.append(document["_id"])
+        if errors:
+            raise BulkWriteError({"nInserted": len(inserted), "writeErrors": errors})
+        return InsertManyResult(inserted)
+
+
+class FakeUser:
+    def __init__(self, user_id):
+        self.id = user_id
+        self.name = f"user{user_id}"
+        self.discriminator = "0001"
+        self.display_avatar = SimpleNamespace(url=f"https://cdn.discordapp.com/embed/avatars/{user_id % 5}.png")
+
+    def __str__(self):
+        return f"{self.name}#{self.discriminator}"
+
+
+class FileResponse:
+    def __init__(self, path):
+        self.path = path
+        self.content_length = os.path.getsize(path)
+        self.content = self
+
+    def raise_for_status(self):
+        pass
+
+    async def read(self):
+        with open(self.path, "rb") as f:
+            return f.read()
+
+    async def iter_chunked(self, size):
+        with open(self.path, "rb") as f:
+            while chunk := f.read(size):
+                yield chunk
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        pass
+
+
+class FileSession:
+    """Serves the generated database in place of an aiohttp session"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def get(self, url):
+        return FileResponse(self.path)
+
+
+class FakeConfig(dict):
+    def __init__(self):
+        super().__init__(log_url="https://logs.example.com/", log_url_prefix="NONE", snippets={})
+        self.cache = self
+        self.snippets = self["snippets"]
+
+    async def update(self):
+        pass
+
+
+class FakeBot:
+    main_color = 0x1ABC9C
+    guild_id = 1
+    latency = 0.05
+
+    def __init__(self, path, fetch_latency, mongo_latency):
+        self.fetch_latency = fetch_latency
+        self.fetches = 0
+        self.users = []
+        self.blocked_users = {}
+        self.config = FakeConfig()
+        self.session = FileSession(path)
+        self.plugin_partition = MemoryCollection(mongo_latency)
+        self.db = SimpleNamespace(logs=MemoryCollection(mongo_latency))
+        self.api = self
+
+    def get_plugin_partition(self, cog):
+        return self.plugin_partition
+
+    def get_user(self, user_id):
+        return None
+
+    async def fetch_user(self, user_id):
+        self.fetches += 1
+        await asyncio.sleep(self.fetch_latency)
+        return FakeUser(user_id)
+
+
+class FakeMessage:
+    attachments = []
+
+    async def edit(self, **kwargs):
+        pass
+
+
+class FakeContext:
+    def __init__(self, bot):
+        self.bot = bot
+        self.message = FakeMessage()
+
+    async def send(self, content=None, **kwargs):
+        return FakeMessage()
+
+
+class Timings:
+    def __init__(self):
+        self.stages = []
+
+    def record(self, name, elapsed, rows):
+        self.stages.append((name, elapsed, rows))
+
+    def print(self):
+        print(f"{'stage':<22}{'seconds':>10}{'rows':>10}{'rows/s':>12}")
+        for name, elapsed, rows in self.stages:
+            rate = rows / elapsed if elapsed else 0
+            print(f"{name:<22}{elapsed:>10.3f}{rows:>10}{rate:>12.0f}")
+        # ru_maxrss is in KiB on linux
+        print(f"peak rss: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MiB")
+
+
+async def run_stages(plugin, args, path, timings):
+    bot = FakeBot(path, args.latency, args.mongo_latency)
+    plugin.USER_CACHE = plugin.UserCache()
+
+    start = time.perf_counter()
+    db = await plugin.DragoryDatabase.download(bot.session, "file://" + path)
+    timings.record("download", time.perf_counter() - start, os.path.getsize(path) // 1024)
+    try:
+        start = time.perf_counter()
+        user_ids = await db.user_ids()
+        await plugin.UserPrefetcher(bot).prefetch(user_ids)
+        timings.record("prefetch users", time.perf_counter() - start, bot.fetches)
+
+        start = time.perf_counter()
+        threads = [thread async for thread in db.iter_threads()]
+        timings.record("scan threads", time.perf_counter() - start, len(threads))
+
+        users = plugin.BotUsers(bot, await plugin.build_name_index(bot, db))
+        start = time.perf_counter()
+        parsed = [plugin.Thread.from_data(bot.guild_id, row, messages, users) for row, messages in threads]
+        timings.record("Thread.from_data", time.perf_counter() - start, len(parsed))
+
+        start = time.perf_counter()
+        documents = [thread.serialize() for thread in parsed]
+        timings.record("Thread.serialize", time.perf_counter() - start, len(documents))
+
+        for document, (row, _) in zip(documents, threads):
+            document["_id"] = document["key"] = plugin.log_key(row[0])
+        writer = plugin.LogWriter(bot.db.logs)
+        start = time.perf_counter()
+        for document in documents:
+            await writer.add(document)
+        await writer.close()
+        timings.record("write logs", time.perf_counter() - start, writer.inserted)
+    finally:
+        await db.close()
+
+
+async def run_pipeline(plugin, args, path, timings):
+    bot = FakeBot(path, args.latency, args.mongo_latency)
+    plugin.USER_CACHE = plugin.UserCache()
+    cog = plugin.DragoryMigrateRemux(bot)
+    flags = ["--processes"] if args.processes else []
+
+    start = time.perf_counter()
+    await cog.migratedb.callback(cog, FakeContext(bot), "file://" + path, *flags)
+    timings.record("migratedb", time.perf_counter() - start, len(bot.db.logs.documents))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--threads", type=int, default=2000)
+    parser.add_argument("--messages", type=int, default=20, help="messages per thread")
+    parser.add_argument("--users", type=int, default=1000, help="distinct users")
+    parser.add_argument("--attachments", type=float, default=0.1, help="ratio of messages with an attachment")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds per fetch_user call")
+    parser.add_argument("--mongo-latency", type=float, default=0.0, help="seconds per mongo call")
+    parser.add_argument("--processes", action="store_true", help="run migratedb with --processes")
+    parser.add_argument("--db", help="reuse or keep the generated database at this path")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    plugin = load_plugin()
+    plugin.USER_CACHE_SNAPSHOT = None
+    plugin.PROGRESS_INTERVAL = 1
+
+    if args.db:
+        path = args.db
+    else:
+        fd, path = tempfile.mkstemp(prefix="dragory-bench-", suffix=".sqlite")
+        os.close(fd)
+    if not os.path.exists(path) or not os.path.getsize(path):
+        start = time.perf_counter()
+        generate(path, args.threads, args.messages, args.users, args.attachments, args.seed)
+        print(f"generated {path} in {time.perf_counter() - start:.1f}s ({os.path.getsize(path) / 1024 / 1024:.1f} MiB)")
+
+    timings = Timings()
+    try:
+        asyncio.run(run_stages(plugin, args, path, timings))
+        asyncio.run(run_pipeline(plugin, args, path, timings))
+    finally:
+        if not args.db:
+            os.remove(path)
+    timings.print()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,133 @@
 import asyncio
-from typing import Union
+import copy
+from typing import Optional, Union
 
 import discord
 from discord.ext import commands
+from pymongo import ReturnDocument
 
 from core import checks, utils
-from core.models import PermissionLevel
+from core.models import getLogger, PermissionLevel
+
+
+config_write_delay = 2  # seconds config changes are held for before being written as one update
+config_poll_interval = 30  # seconds between checks for config changes made by other bot instances
+
+
+class ConfigStore(object):
+    """
+    Versioned snapshot of the plugin config document
+
+    Writes are coalesced into a single `$set` of the changed fields, every write bumps `version`
+    so other bot instances sharing the database notice the change from a cheap poll and reload.
+    """
+
+    def __init__(self, db, on_load, logger, delay=config_write_delay, poll_interval=config_poll_interval):
+        self.db = db
+        self.on_load = on_load  # called with the config document (or None) whenever a new snapshot is loaded
+        self.logger = logger
+        self.delay = delay
+        self.poll_interval = poll_interval
+        self.values: dict = {}
+        self.saved: dict = {}  # values as they are in the db
+        self.version = 0
+        self.loaded = False  # nothing is written before the stored config has been read once
+        self.dirty: set[str] = set()
+        self.lock = asyncio.Lock()
+        self.ready = asyncio.Event()
+        self.flush_task: Optional[asyncio.Task] = None
+        self.watcher: Optional[asyncio.Task] = None
+
+    def start(self):
+        self.watcher = asyncio.create_task(self._watch())
+
+    async def load(self):
+        async with self.lock:
+            if self.loaded and self.dirty:
+                return  # staged changes would be dropped, the next poll after they are written reloads
+            config = await self.db.find_one({"_id": "config"})
+            if config is not None:
+                config.pop("_id")
+                self.version = config.pop("version", 0)
+                self.values = config
+                self.saved = copy.deepcopy(config)
+            self.loaded = True
+        await self.on_load(config)
+
+    async def _watch(self):
+        # retried until it succeeds, events and commands wait on `ready` rather than running on the defaults
+        attempt = 0
+        while not self.loaded:
+            try:
+                await self.load()
+            except Exception:
+                self.logger.warning("Failed to load the config, retrying", exc_info=True)
+                await asyncio.sleep(min(2 ** attempt, self.poll_interval))
+                attempt += 1
+        self.ready.set()
+
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            if self.dirty:
+                continue  # reloaded once our own changes are written
+            try:
+                data = await self.db.find_one({"_id": "config"}, {"version": 1})
+                if data is not None and data.get("version", 0) != self.version:
+                    self.logger.debug("Config changed by another instance, reloading")
+                    await self.load()
+            except Exception:
+                self.logger.warning("Failed to poll the config", exc_info=True)
+
+    def update(self, values: dict):
+        """Stages `values` and schedules a write, lists/dicts mutated in place are picked up when flushing"""
+        self.values.update(values)
+        self.dirty.update(values.keys())
+        if self.flush_task is None or self.flush_task.done():
+            self.flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        # keeps going while changes come in during a write, those would otherwise wait for the next update
+        while self.dirty:
+            await asyncio.sleep(self.delay)
+            await self.flush()
+
+    async def flush(self):
+        if not self.loaded:
+            return  # the defaults would overwrite the stored config, kept in `dirty` until it is loaded
+        async with self.lock:
+            dirty, self.dirty = self.dirty, set()
+            changed = {key: self.values[key] for key in dirty if key in self.values and self.saved.get(key, ...) != self.values[key]}
+            if not changed:
+                return
+
+            try:
+                data = await self.db.find_one_and_update(
+                    {"_id": "config"},
+                    {"$set": changed, "$inc": {"version": 1}},
+                    {"version": 1},
+                    upsert=True,
+                    return_document=ReturnDocument.AFTER,
+                )
+            except BaseException:
+                # also on cancellation, the keys were already taken out of `dirty`
+                self.dirty |= dirty
+                raise
+            self.saved.update(copy.deepcopy(changed))
+            # a skipped version means another instance wrote in between, the watcher picks up its changes
+            if data["version"] == self.version + 1:
+                self.version = data["version"]
+
+    async def close(self):
+        if self.watcher is not None:
+            self.watcher.cancel()
+        if self.flush_task is not None and not self.flush_task.done():
+            # a write in progress puts its keys back into `dirty` when cancelled, the flush below writes them
+            self.flush_task.cancel()
+            try:
+                await self.flush_task
+            except asyncio.CancelledError:
+                pass
+        await self.flush()
 
 
 class logviewer2companion(commands.Cog):
@@ -16,31 +138,33 @@ class logviewer2companion(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
         self.db = bot.api.get_plugin_partition(self)
+        self.logger = getLogger("logviewer2companion")
+        self.config = ConfigStore(self.db, self._set_options, self.logger)
 
         # settings
         self.enabled = True
         self.allow_evidence_share = False
         self.allowed_users: list = list()
         self.allowed_roles: dict = dict()
-        asyncio.create_task(self._set_options())
+        self.config.start()
+
+    async def cog_before_invoke(self, ctx):
+        await self.config.ready.wait()
+
+    async def cog_unload(self):
+        await self.config.close()
 
     async def _update_config(self):
-        await self.db.find_one_and_update(
-            {"_id": "config"},
+        self.config.update(
             {
-                "$set": {
-                    "enabled": self.enabled,
-                    "allow_evidence_share": self.allow_evidence_share,
-                    "allowed_users": self.allowed_users,
-                    "allowed_roles": self.allowed_roles,
-                }
-            },
-            upsert=True,
+                "enabled": self.enabled,
+                "allow_evidence_share": self.allow_evidence_share,
+                "allowed_users": self.allowed_users,
+                "allowed_roles": self.allowed_roles,
+            }
         )
 
-    async def _set_options(self):
-        config = await self.db.find_one({"_id": "config"})
-
+    async def _set_options(self, config: Optional[dict]):
         if config is None:
             await self._update_config()
             return